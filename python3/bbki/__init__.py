@@ -55,6 +55,8 @@ from ._repo import RepoAtom
 
 from ._boot_entry import BootEntry
 
+from ._initramfs_files import InitramfsFilesReader
+
 from ._kernel import KernelInstaller
 from ._kernel import KernelInstallProgress
 
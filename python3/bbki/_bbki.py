@@ -36,6 +36,10 @@ from ._exception import RunningEnvironmentError
 from ._util import Util
 from ._po import FsLayout
 from ._repo_atom_exec import BbkiAtomExecutor
+from ._fetch import Fetcher
+from ._manifest import DistfileStampCache
+from ._git_store import GitStore
+from ._compiler_cache import CompilerCache
 from ._boot_entry import BootEntryUtils
 from ._boot_entry import BootEntryWrapper
 from ._initramfs import InitramfsInstaller
@@ -45,6 +49,9 @@ from ._check import Checker
 
 class Bbki:
 
+    # memory needed by a compile job, used to derive MAKEOPTS automatically
+    MEMORY_PER_MAKE_JOB = 1024 * 1024 * 1024
+
     def __init__(self, cfg, mount_points):
         assert isinstance(cfg, ConfigBase)
         self._cfg = cfg
@@ -69,10 +76,20 @@ class Bbki:
         if not Util.cmdCallTestSuccess("grub-editenv", "-V"):
             raise RunningEnvironmentError("executable \"grub-editenv\" does not exist")
 
+        if self._cfg.get_compiler_cache() is not None:
+            self._compilerCache = CompilerCache.new(self._cfg.get_compiler_cache(), os.path.join(self._cfg.cache_compiler_dir, self._cfg.get_compiler_cache()))
+            if not Util.cmdCallTestSuccess(self._compilerCache.name, "--version"):
+                raise RunningEnvironmentError("executable \"%s\" does not exist" % (self._compilerCache.name))
+        else:
+            self._compilerCache = None
+
         self._repoList = [
-            Repo(self._cfg.data_repo_dir),
+            Repo(self._cfg.data_repo_dir, index_file=os.path.join(self._cfg.cache_metadata_dir, "repo-main.index")),
         ]
 
+        # distfiles verified against Manifest are recorded, so that they are not hashed again
+        self._distfileStampCache = DistfileStampCache(os.path.join(self._cfg.cache_metadata_dir, "distfiles.stamps"))
+
         if len(mount_points) > 0:
             self._initramfsInstaller = InitramfsInstaller(self)
         else:
@@ -142,33 +159,29 @@ class Bbki:
         return ret
 
     def get_kernel_atom(self):
-        items = self._repoList[0].get_atoms_by_type_name(self._cfg.get_kernel_type(), Repo.ATOM_TYPE_KERNEL, self._cfg.get_kernel_name())
-        items = [x for x in items if self._cfg.test_version_mask(x.fullname, x.verstr)]                    # filter by bbki-config
-        if len(items) > 0:
-            return items[-1]
-        else:
-            return None
+        return self._getNewestAtom(Repo.ATOM_TYPE_KERNEL, self._cfg.get_kernel_name())
 
     def get_kernel_addon_atoms(self):
         ret = []
         for name in self._cfg.get_kernel_addon_names():
-            items = self._repoList[0].get_atoms_by_type_name(self._cfg.get_kernel_type(), Repo.ATOM_TYPE_KERNEL_ADDON, name)
-            items = [x for x in items if self._cfg.test_version_mask(x.fullname, x.verstr)]                # filter by bbki-config
-            if len(items) > 0:
-                ret.append(items[-1])
+            item = self._getNewestAtom(Repo.ATOM_TYPE_KERNEL_ADDON, name)
+            if item is not None:
+                ret.append(item)
         return ret
 
     def get_initramfs_atom(self):
-        items = self._repoList[0].get_atoms_by_type_name(self._cfg.get_kernel_type(), Repo.ATOM_TYPE_INITRAMFS, self._cfg.get_initramfs_name())
-        items = [x for x in items if self._cfg.test_version_mask(x.fullname, x.verstr)]                    # filter by bbki-config
-        if len(items) > 0:
-            return items[-1]
-        else:
-            return None
+        return self._getNewestAtom(Repo.ATOM_TYPE_INITRAMFS, self._cfg.get_initramfs_name())
 
     def fetch(self, atom):
         BbkiAtomExecutor(self, atom).exec_fetch()
 
+    def fetch_atoms(self, atom_list):
+        # distfiles of all the atoms are downloaded concurrently
+        fetcher = Fetcher(stamp_cache=self._distfileStampCache)
+        for atom in atom_list:
+            BbkiAtomExecutor(self, atom).add_fetch_tasks(fetcher)
+        fetcher.run()
+
     def get_kernel_installer(self, kernel_atom, kernel_addon_atom_list, initramfs_atom=None):
         assert kernel_atom.atom_type == Repo.ATOM_TYPE_KERNEL
         assert all([x.atom_type == Repo.ATOM_TYPE_KERNEL_ADDON for x in kernel_addon_atom_list])
@@ -241,32 +254,36 @@ class Bbki:
         # return value
         return (bootFileList, modulesFileList, firmwareFileList)
 
-    def clean_distfiles(self, pretend=False):
-        return []                               # FIXME
-        # def findDeprecatedFiles(self, destructive=False):
-        #     keepFiles = set()
-        #     for repo in self._bbki.repositories:
-        #         for atomType, atomName in repo.query_atom_type_name():
-        #             items = repo.get_atoms_by_type_name(atomType, atomName)
-        #             if destructive:
-        #                 items = [items[-1]]
-        #             for item in items:
-        #                 keepFiles |= set([fn for t, r, fn in item.get_distfiles()])
-        #     keepFiles.add("git-src")
-
-        #     ret = []
-        #     for fn in os.listdir(self._bbki.cache_distfiles_dir):
-        #         if fn not in keepFiles:
-        #             ret.append(fn)
-        #             continue
-        #         if fn == "git-src":
-        #             for fn2 in os.listdir(os.path.join(self._bbki.cache_distfiles_dir, "git-src")):
-        #                 fn2 = os.path.join("git-src", fn2)
-        #                 if fn2 in keepFiles:
-        #                     continue
-        #                 ret.append(fn2)
-        #             continue
-        #     return ret
+    def clean_distfiles(self, pretend=False, keep_newest=None):
+        # keep_newest: only keep distfiles of the newest N versions of each atom, None means keeping all the versions in repositories
+        # read-only distfile directories are never touched
+        # returns list of to-be-deleted files and directories, use get_distfiles_clean_report() for details
+        fileList, gitSrcDirList, gitStoreList, customSrcDirList = self._getDistfilesToClean(keep_newest)
+
+        # delete files
+        if not pretend:
+            for fullfn in fileList + gitSrcDirList + customSrcDirList:
+                robust_layer.simple_fops.rm(fullfn)
+            GitStore(os.path.join(self._cfg.cache_distfiles_dir, GitStore.DIR_NAME)).remove_distfiles(gitStoreList)
+
+        # return value
+        return fileList + gitSrcDirList + [os.path.join(self._cfg.cache_distfiles_dir, x) for x in gitStoreList] + customSrcDirList
+
+    def get_distfiles_clean_report(self, keep_newest=None):
+        # returns (file-list, git-src-list, custom-src-dir-list, reclaimable-size) for what clean_distfiles() would delete
+        # size of objects pruned from git store is not included in reclaimable-size
+        fileList, gitSrcDirList, gitStoreList, customSrcDirList = self._getDistfilesToClean(keep_newest)
+
+        size = 0
+        for fullfn in fileList + gitSrcDirList + customSrcDirList:
+            if os.path.isdir(fullfn) and not os.path.islink(fullfn):
+                for root, dirs, files in os.walk(fullfn):
+                    for fn in files:
+                        size += os.lstat(os.path.join(root, fn)).st_size
+            else:
+                size += os.lstat(fullfn).st_size
+
+        return (fileList, gitSrcDirList + [os.path.join(self._cfg.cache_distfiles_dir, x) for x in gitStoreList], customSrcDirList, size)
 
     def remove_all(self):
         if self._bootloader is not None:
@@ -287,3 +304,62 @@ class Bbki:
         obj.checkBootDir()
         obj.checkKernelModulesDir()
         obj.checkFirmwareDir()
+
+    def _getMakeOpts(self):
+        # MAKEOPTS in make.conf is used as is, unless it is empty or "auto"
+        # job count is limited by usable CPUs (affinity and cgroup quota) and available memory, load average is limited by usable CPUs
+        ret = self._cfg.get_build_variable("MAKEOPTS").strip()
+        if ret not in ["", "auto"]:
+            return ret
+        cpuCount = Util.getCpuCount()
+        jobs = max(1, min(cpuCount, Util.getAvailableMemory() // self.MEMORY_PER_MAKE_JOB))
+        return "-j%d -l%d" % (jobs, cpuCount)
+
+    def _getDistfilesToClean(self, keep_newest):
+        # returns (file-list, git-src-dir-list, git-store-distfile-list, custom-src-dir-list)
+        assert keep_newest is None or keep_newest >= 0
+
+        # distfiles referenced by atoms, variable values come from metadata cache so that bash is seldomly needed
+        keepSet = set()
+        for repo in self._repoList:
+            for kernelType, atomType, atomName in repo.query_atom_type_name():
+                items = repo.get_atoms_by_type_name(kernelType, atomType, atomName)
+                if keep_newest is not None:
+                    items = items[len(items) - keep_newest:] if keep_newest > 0 else []
+                for item in items:
+                    keepSet |= set(BbkiAtomExecutor(self, item).get_distfiles())
+
+        distfilesDir = self._cfg.cache_distfiles_dir
+        gitStore = GitStore(os.path.join(distfilesDir, GitStore.DIR_NAME))
+        fileList = []
+        gitSrcDirList = []
+        gitStoreList = [x for x in gitStore.get_distfiles() if x not in keepSet]
+        customSrcDirList = []
+        if os.path.exists(distfilesDir):
+            for fn in sorted(os.listdir(distfilesDir)):
+                if fn == GitStore.DIR_NAME:
+                    pass
+                elif fn == "git-src":
+                    # checkouts made by old versions, git distfiles are in git store now
+                    gitSrcDirList.append(os.path.join(distfilesDir, fn))
+                elif fn == "custom-src":
+                    # layout: custom-src/<category>/<atom-name>
+                    for fn2 in sorted(glob.glob(os.path.join(distfilesDir, fn, "*", "*"))):
+                        if os.path.relpath(fn2, distfilesDir) not in keepSet:
+                            customSrcDirList.append(fn2)
+                elif fn.endswith(".part"):
+                    # partial download is kept for resuming
+                    if fn[:len(".part") * -1] not in keepSet:
+                        fileList.append(os.path.join(distfilesDir, fn))
+                elif fn not in keepSet:
+                    fileList.append(os.path.join(distfilesDir, fn))
+
+        return (fileList, gitSrcDirList, gitStoreList, customSrcDirList)
+
+    def _getNewestAtom(self, atom_type, atom_name):
+        # atom list is sorted from old to new, so search from the end and stop at the first unmasked one
+        items = self._repoList[0].get_atoms_by_type_name(self._cfg.get_kernel_type(), atom_type, atom_name)
+        for item in reversed(items):
+            if self._cfg.test_version_mask(item.fullname, item.verstr):                                 # filter by bbki-config
+                return item
+        return None
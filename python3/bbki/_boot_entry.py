@@ -22,11 +22,14 @@
 
 
 import os
-import re
 import kmod
 import glob
+import json
+import concurrent.futures
 import robust_layer.simple_fops
 from ._util import Util
+from ._modinfo import ModInfo
+from ._initramfs_files import InitramfsFilesReader
 
 
 class BootEntry:
@@ -113,14 +116,25 @@ class BootEntry:
         # string, eg: "/boot/initramfs-x86_64-3.9.11-gentoo-r1"
         return os.path.join(self._bootDir, self.initrd_filename)
 
+    @property
+    def initrd_files_filename(self):
+        # string, eg: "initramfs-files-x86_64-3.9.11-gentoo-r1.zip"
+        return "initramfs-files-" + self.postfix + ".zip"
+
+    @property
+    def initrd_files_filepath(self):
+        # string, eg: "/boot/initramfs-files-x86_64-3.9.11-gentoo-r1.zip"
+        return os.path.join(self._bootDir, self.initrd_files_filename)
+
     @property
     def initrd_tar_filename(self):
         # string, eg: "initramfs-files-x86_64-3.9.11-gentoo-r1.tar.bz2"
+        # legacy format, only boot entries created by old versions have this file
         return "initramfs-files-" + self.postfix + ".tar.bz2"
 
     @property
     def initrd_tar_filepath(self):
-        # string, eg: "/boot/initramfs-x86_64-3.9.11-gentoo-r1.tar.bz2"
+        # string, eg: "/boot/initramfs-files-x86_64-3.9.11-gentoo-r1.tar.bz2"
         return os.path.join(self._bootDir, self.initrd_tar_filename)
 
     def is_historical(self):
@@ -142,7 +156,7 @@ class BootEntry:
     def has_initrd_files(self):
         if not os.path.exists(self.initrd_filepath):
             return False
-        if not os.path.exists(self.initrd_tar_filepath):
+        if not os.path.exists(self.initrd_files_filepath) and not os.path.exists(self.initrd_tar_filepath):
             return False
         return True
 
@@ -154,10 +168,18 @@ class BootEntry:
 
 class BootEntryWrapper:
 
-    def __init__(self, boot_entry):
+    # use process pool only when there are enough kernel modules to scan, spawning processes is not free
+    PARALLEL_SCAN_THRESHOLD = 64
+
+    def __init__(self, boot_entry, scan_jobs=None):
+        # scan_jobs: number of processes used to scan kernel modules, None means os.cpu_count(), 1 means no process pool
+        assert scan_jobs is None or scan_jobs >= 1
+
         self._bbki = boot_entry._bbki
         self._bootEntry = boot_entry
+        self._scanJobs = scan_jobs if scan_jobs is not None else os.cpu_count()
         self._modulesDir = self._bbki._fsLayout.get_kernel_modules_dir(self._bootEntry.verstr)
+        self._fwIndexFile = os.path.join(self._modulesDir, "firmware.index")
 
     @property
     def src_arch(self):
@@ -178,9 +200,17 @@ class BootEntryWrapper:
             self._bootEntry.kernel_config_filepath,
             self._bootEntry.kernel_config_rules_filepath,
             self._bootEntry.initrd_filepath,
+            self._bootEntry.initrd_files_filepath,
             self._bootEntry.initrd_tar_filepath,
         ]
 
+    def open_initrd_files(self):
+        # returns InitramfsFilesReader, legacy format is used only when the new format does not exist
+        if os.path.exists(self._bootEntry.initrd_files_filepath):
+            return InitramfsFilesReader(self._bootEntry.initrd_files_filepath)
+        else:
+            return InitramfsFilesReader(self._bootEntry.initrd_tar_filepath)
+
     def get_kmod_filenames_by_alias(self, kmod_alias, with_deps=False):
         return [x[len(self._modulesDir):] for x in self.get_kmod_filepaths_by_alias(kmod_alias, with_deps)]
 
@@ -192,13 +222,8 @@ class BootEntryWrapper:
 
     def get_firmware_filenames_by_kmod(self, kmod_filepath):
         # python-kmod bug: can only recognize the last firmware in modinfo
-        # so use the command output of modinfo directly
-        ret = []
-        for line in Util.cmdCall("/bin/modinfo", kmod_filepath).split("\n"):
-            m = re.fullmatch("firmware: +(\\S.*)", line)
-            if m is not None:
-                ret.append(m.group(1))
-        return ret
+        # so read the .modinfo section of the kernel module file directly
+        return ModInfo(kmod_filepath).firmware
 
     def get_firmware_filepaths_by_kmod(self, kmod_filepath):
         return [os.path.join(self._bbki._fsLayout.get_firmware_dir(), x) for x in self.get_firmware_filenames_by_kmod(kmod_filepath)]
@@ -206,8 +231,8 @@ class BootEntryWrapper:
     def get_firmware_filenames(self):
         ret = set()
 
-        for fullKoFn in glob.glob(os.path.join(self._modulesDir, "**", "*.ko"), recursive=True):
-            ret |= set(self.get_firmware_filenames_by_kmod(fullKoFn))
+        for size, mtime, fwList in self._refreshFirmwareIndex(bIgnoreError=True).values():
+            ret |= set(fwList)
 
         fwExtFileRecordFn = os.path.join(self._bootEntry.kernel_modules_dirpath, "firmware.extra-files")
         if os.path.exists(fwExtFileRecordFn):
@@ -218,12 +243,59 @@ class BootEntryWrapper:
     def get_firmware_filepaths(self):
         return [os.path.join(self._bbki._fsLayout.get_firmware_dir(), x) for x in self.get_firmware_filenames()]
 
+    def update_firmware_index(self):
+        # the index is kept in kernel modules directory, it is always fresh after this call
+        self._refreshFirmwareIndex(bIgnoreError=False)
+
     def move_to_history(self):
         robust_layer.simple_fops.mkdir(self._bbki._fsLayout.get_boot_history_dir())
         for fullfn in self.get_filepaths():
             if os.path.exists(fullfn):
                 robust_layer.simple_fops.mv_to_dir(fullfn, self._bbki._fsLayout.get_boot_history_dir())
 
+    def _refreshFirmwareIndex(self, bIgnoreError):
+        # bIgnoreError: queries are used by normal user, for whom the kernel modules directory is not writable
+        # firmware index format: {
+        #     "kernel/drivers/xxx.ko": [size, mtime_ns, ["firmware-filename", ...]],
+        # }
+        # an entry is re-generated only when the size or mtime of the kernel module file changes
+
+        oldIndex = dict()
+        try:
+            with open(self._fwIndexFile, "r") as f:
+                oldIndex = json.load(f)
+        except (FileNotFoundError, ValueError):
+            pass
+
+        newIndex = dict()
+        staleList = []
+        for fullKoFn in ModInfo.glob_kmod_files(self._modulesDir):
+            st = os.stat(fullKoFn)
+            koFn = fullKoFn[len(self._modulesDir) + 1:]
+            item = oldIndex.get(koFn)
+            if item is not None and item[0] == st.st_size and item[1] == st.st_mtime_ns:
+                newIndex[koFn] = item
+            else:
+                newIndex[koFn] = [st.st_size, st.st_mtime_ns, None]
+                staleList.append(koFn)
+
+        fullKoFnList = [os.path.join(self._modulesDir, x) for x in staleList]
+        for koFn, fwList in zip(staleList, self._scanKmodFiles(_getKmodFirmwareFilenames, fullKoFnList)):
+            newIndex[koFn][2] = fwList
+
+        if newIndex != oldIndex and os.path.isdir(self._modulesDir):
+            Util.writeJsonFile(self._fwIndexFile, newIndex, bIgnoreError=bIgnoreError)
+
+        return newIndex
+
+    def _scanKmodFiles(self, func, fullKoFnList):
+        # returns results in the same order as fullKoFnList, no matter the scan is parallel or not
+        if self._scanJobs == 1 or len(fullKoFnList) < self.PARALLEL_SCAN_THRESHOLD:
+            return [func(x) for x in fullKoFnList]
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self._scanJobs) as executor:
+            chunkSize = max(1, len(fullKoFnList) // (self._scanJobs * 4))
+            return list(executor.map(func, fullKoFnList, chunksize=chunkSize))
+
     def _getKmodAndDeps(self, ctx, kmodAlias, withDeps, result):
         kmodObjList = list(ctx.lookup(kmodAlias))
         if len(kmodObjList) > 0:
@@ -239,6 +311,11 @@ class BootEntryWrapper:
                 result[kmodObj.path] = None
 
 
+def _getKmodFirmwareFilenames(kmod_filepath):
+    # module level function, so that it can be used in process pool
+    return ModInfo(kmod_filepath).firmware
+
+
 class BootEntryUtils:
 
     def __init__(self, bbki):
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2005-2014 Fpemud <fpemud@sina.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import os
+import json
+import subprocess
+from ._exception import ConfigError
+
+
+class CompilerCache:
+
+    """Compiler cache used by kernel and kernel addon builds.
+       The emake helper prefixes CC and HOSTCC with the compiler cache command, cache directory is given by environment variable."""
+
+    # name used in bbki.options, it is also the executable name
+    NAME = None
+
+    # environment variable which specifies cache directory
+    DIR_VARIABLE = None
+
+    @staticmethod
+    def get_compiler_cache_names():
+        return [x.NAME for x in _compilerCacheList]
+
+    @staticmethod
+    def new(name, cache_dir):
+        for klass in _compilerCacheList:
+            if klass.NAME == name:
+                return klass(cache_dir)
+        raise ConfigError("invalid compiler cache \"%s\"" % (name))
+
+    def __init__(self, cacheDir):
+        self._cacheDir = cacheDir
+
+    @property
+    def name(self):
+        return self.NAME
+
+    @property
+    def cache_dir(self):
+        return self._cacheDir
+
+    def get_env_vars(self):
+        # returns {name: value}
+        return {
+            "BBKI_COMPILER_CACHE": self.NAME,
+            self.DIR_VARIABLE: self._cacheDir,
+        }
+
+    def get_stats(self):
+        # returns (hits, misses), counters are cumulative, so the caller should calculate the difference
+        # returns None if statistics is not available, eg. compiler cache is too old
+        try:
+            return self._getStats()
+        except (OSError, subprocess.CalledProcessError, ValueError, KeyError):
+            return None
+
+    def _getStats(self):
+        raise NotImplementedError()
+
+    def _callWithEnv(self, *args):
+        env = dict(os.environ)
+        env.update(self.get_env_vars())
+        return subprocess.run(args, env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True, check=True).stdout
+
+
+class CompilerCacheCcache(CompilerCache):
+
+    NAME = "ccache"
+
+    DIR_VARIABLE = "CCACHE_DIR"
+
+    def _getStats(self):
+        # "ccache --print-stats" gives machine readable "<key>\t<value>" lines
+        statDict = dict()
+        for line in self._callWithEnv("ccache", "--print-stats").split("\n"):
+            partList = line.split("\t")
+            if len(partList) == 2 and partList[1].isdigit():
+                statDict[partList[0]] = int(partList[1])
+        hits = statDict.get("direct_cache_hit", 0) + statDict.get("preprocessed_cache_hit", 0)
+        misses = statDict.get("cache_miss", 0)
+        return (hits, misses)
+
+
+class CompilerCacheSccache(CompilerCache):
+
+    NAME = "sccache"
+
+    DIR_VARIABLE = "SCCACHE_DIR"
+
+    def _getStats(self):
+        # sccache server is started with the cache directory if it is not running
+        stats = json.loads(self._callWithEnv("sccache", "--show-stats", "--stats-format=json"))["stats"]
+        hits = sum(stats.get("cache_hits", {}).get("counts", {}).values())
+        misses = sum(stats.get("cache_misses", {}).get("counts", {}).values())
+        return (hits, misses)
+
+
+_compilerCacheList = [
+    CompilerCacheCcache,
+    CompilerCacheSccache,
+]
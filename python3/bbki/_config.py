@@ -35,6 +35,31 @@ class ConfigBase:
     def cache_distfiles_ro_dir_list(self):
         raise NotImplementedError()
 
+    @property
+    def cache_metadata_dir(self):
+        raise NotImplementedError()
+
+    @property
+    def cache_initramfs_dir(self):
+        raise NotImplementedError()
+
+    @property
+    def cache_srctree_dir(self):
+        raise NotImplementedError()
+
+    @property
+    def cache_kbuild_dir(self):
+        raise NotImplementedError()
+
+    @property
+    def cache_compiler_dir(self):
+        raise NotImplementedError()
+
+    @property
+    def cache_srctree_max_size(self):
+        # in bytes, 0 means source tree cache is disabled
+        raise NotImplementedError()
+
     @property
     def tmp_dir(self):
         raise NotImplementedError()
@@ -48,12 +73,21 @@ class ConfigBase:
     def get_kernel_name(self):
         raise NotImplementedError()
 
+    def get_compiler_cache(self):
+        # returns compiler cache name, returns None if compiler cache is disabled
+        raise NotImplementedError()
+
     def get_kernel_addon_names(self):
         raise NotImplementedError()
 
     def get_initramfs_name(self):
         raise NotImplementedError()
 
+    def get_initramfs_compression(self):
+        # returns (compressor-name, level, threads)
+        # compressor-name can be "auto", level can be None (default level), threads can be 0 (all the CPUs)
+        raise NotImplementedError()
+
     def get_system_init(self):
         raise NotImplementedError()
 
@@ -63,6 +97,10 @@ class ConfigBase:
     def get_kernel_extra_init_cmdline(self):
         raise NotImplementedError()
 
+    def get_kernel_incremental_build(self):
+        # returns True if build directory of kernel is kept across installations
+        raise NotImplementedError()
+
     def test_version_mask(self, item_fullname, item_verstr):
         raise NotImplementedError()
 
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2005-2014 Fpemud <fpemud@sina.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import os
+import stat
+
+
+class CpioNewcWriter:
+
+    """Writes cpio archive in "newc" format (the format linux kernel uses for initramfs) to a file object.
+       File content is streamed, so the file object can be a compressor directly.
+       Owner is always root and mtime is fixed, so that the archive is reproducible."""
+
+    MAGIC = b"070701"
+
+    TRAILER = "TRAILER!!!"
+
+    BUFFER_SIZE = 1024 * 1024
+
+    def __init__(self, fileobj, mtime=0):
+        self._f = fileobj
+        self._mtime = mtime
+        self._ino = 0
+        self._closed = False
+
+    def add_directory(self, name, mode=0o755):
+        self._writeHeader(name, stat.S_IFDIR | mode, 0, 2)
+
+    def add_symlink(self, name, target):
+        data = target.encode("utf-8")
+        self._writeHeader(name, stat.S_IFLNK | 0o777, len(data), 1)
+        self._f.write(data)
+        self._writePadding(len(data))
+
+    def add_data(self, name, data, mode=0o644):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self._writeHeader(name, stat.S_IFREG | mode, len(data), 1)
+        self._f.write(data)
+        self._writePadding(len(data))
+
+    def add_file(self, name, filepath, mode=None):
+        with open(filepath, "rb") as f:
+            st = os.fstat(f.fileno())
+            if mode is None:
+                mode = stat.S_IMODE(st.st_mode)
+            self._writeHeader(name, stat.S_IFREG | mode, st.st_size, 1)
+            remain = st.st_size
+            while remain > 0:
+                buf = f.read(min(remain, self.BUFFER_SIZE))
+                if buf == b"":
+                    raise IOError("\"%s\" is truncated while being read" % (filepath))
+                self._f.write(buf)
+                remain -= len(buf)
+            self._writePadding(st.st_size)
+
+    def close(self):
+        if not self._closed:
+            self._writeHeader(self.TRAILER, 0, 0, 1, ino=0)
+            self._closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.close()
+
+    def _writeHeader(self, name, mode, fileSize, nlink, ino=None):
+        assert not self._closed
+
+        name = name.lstrip("/").encode("utf-8") + b"\0"
+        if ino is None:
+            self._ino += 1
+            ino = self._ino
+
+        buf = self.MAGIC
+        for v in [ino, mode, 0, 0, nlink, self._mtime, fileSize, 0, 0, 0, 0, len(name), 0]:
+            buf += b"%08X" % (v)
+        buf += name
+        self._f.write(buf)
+        self._writePadding(len(buf))
+
+    def _writePadding(self, size):
+        # header+name and file data are both padded to 4 bytes
+        if size % 4 != 0:
+            self._f.write(b"\0" * (4 - size % 4))
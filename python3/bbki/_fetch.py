@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2005-2014 Fpemud <fpemud@sina.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import os
+import re
+import threading
+import http.client
+import urllib.parse
+import urllib.request
+import concurrent.futures
+import robust_layer.wget
+from ._exception import FetchError
+
+
+class Fetcher:
+
+    """Downloads files concurrently.
+       HTTP(S) connections are kept alive and reused per host, partial downloads are resumed by range requests,
+       data is written to "<filepath>.part" which is renamed to the target filepath when download completes.
+       If manifest entry is specified, data is verified while being downloaded, existing file is verified through stamp cache."""
+
+    DEFAULT_JOBS = 4
+
+    RETRY_COUNT = 3
+
+    TIMEOUT = 60
+
+    MAX_REDIRECTS = 10
+
+    def __init__(self, jobs=None, stamp_cache=None):
+        self._jobs = jobs if jobs is not None else self.DEFAULT_JOBS
+        self._stampCache = stamp_cache
+        self._taskDict = dict()                 # {target: (func, args)}, use dict to remove duplication while keeping order
+        self._connPool = _ConnectionPool(self.TIMEOUT)
+
+    def add_url(self, url, filepath, dist_entry=None):
+        # dist_entry: ManifestDistEntry, None means no verification
+        self._taskDict.setdefault(filepath, (self._download, (url, filepath, dist_entry)))
+
+    def add_git(self, url, git_store, local_fn):
+        # git distfile is fetched into the shared GitStore
+        self._taskDict.setdefault(local_fn, (git_store.fetch, (url, local_fn)))
+
+    def add_func(self, key, func, *args):
+        # custom task, key is used to remove duplication
+        self._taskDict.setdefault(key, (func, args))
+
+    def run(self):
+        try:
+            with concurrent.futures.ThreadPoolExecutor(self._jobs) as executor:
+                futureList = [executor.submit(func, *args) for func, args in self._taskDict.values()]
+                concurrent.futures.wait(futureList)
+            for f in futureList:
+                f.result()                      # raise the first exception
+        finally:
+            self._connPool.close()
+            self._taskDict = dict()
+            if self._stampCache is not None:
+                self._stampCache.save()
+
+    def _download(self, url, filepath, distEntry):
+        if os.path.exists(filepath):
+            if distEntry is None:
+                return
+            try:
+                self._verify(filepath, distEntry)
+                return
+            except FetchError:
+                # existing file is corrupt, download it again
+                os.unlink(filepath)
+
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        partFile = filepath + ".part"
+
+        if urllib.parse.urlsplit(url).scheme not in ["http", "https"]:
+            robust_layer.wget.exec("-O", partFile, url)
+            if distEntry is not None:
+                try:
+                    distEntry.verify_file(partFile)
+                except FetchError:
+                    os.unlink(partFile)
+                    raise
+            os.rename(partFile, filepath)
+            self._addStamp(filepath, distEntry)
+            return
+
+        for i in range(0, self.RETRY_COUNT):
+            try:
+                self._downloadOnce(url, partFile, distEntry)
+                break
+            except (OSError, http.client.HTTPException) as e:
+                # part file is kept, so that the next try resumes from it
+                if i == self.RETRY_COUNT - 1:
+                    raise FetchError("failed to download \"%s\", %s" % (url, e))
+        os.rename(partFile, filepath)
+        self._addStamp(filepath, distEntry)
+
+    def _verify(self, filepath, distEntry):
+        if self._stampCache is not None:
+            self._stampCache.verify(filepath, distEntry)
+        else:
+            distEntry.verify_file(filepath)
+
+    def _addStamp(self, filepath, distEntry):
+        if self._stampCache is not None and distEntry is not None:
+            self._stampCache.add_stamp(filepath, distEntry)
+
+    def _downloadOnce(self, url, partFile, distEntry):
+        for i in range(0, self.MAX_REDIRECTS):
+            offset = os.path.getsize(partFile) if os.path.exists(partFile) else 0
+
+            headers = {
+                "User-Agent": "bbki",
+                "Accept-Encoding": "identity",
+            }
+            if offset > 0:
+                headers["Range"] = "bytes=%d-" % (offset)
+
+            conn, key, path = self._connPool.get(url)
+            try:
+                conn.request("GET", path, headers=headers)
+                resp = conn.getresponse()
+
+                if resp.status in [301, 302, 303, 307, 308]:
+                    resp.read()
+                    url = urllib.parse.urljoin(url, resp.getheader("Location"))
+                    continue
+
+                if resp.status == 416 and offset > 0:
+                    # part file is already complete, or it is not the same file as the remote one
+                    resp.read()
+                    m = re.fullmatch(r'bytes \*/([0-9]+)', resp.getheader("Content-Range", ""))
+                    if m is not None and int(m.group(1)) == offset:
+                        if distEntry is not None:
+                            try:
+                                distEntry.verify_file(partFile)
+                            except FetchError:
+                                os.unlink(partFile)
+                                raise
+                        return
+                    os.unlink(partFile)
+                    continue
+
+                if resp.status == 206 and offset > 0:
+                    m = re.fullmatch(r'bytes ([0-9]+)-.*', resp.getheader("Content-Range", ""))
+                    if m is None or int(m.group(1)) != offset:
+                        raise http.client.HTTPException("invalid Content-Range header")
+                    mode = "ab"
+                elif resp.status == 200:
+                    mode = "wb"
+                else:
+                    resp.read()
+                    raise FetchError("failed to download \"%s\", HTTP status %d" % (url, resp.status))
+
+                # data is hashed while being written, only the resumed part file needs an extra read
+                checker = distEntry.new_checker() if distEntry is not None else None
+                if checker is not None and mode == "ab":
+                    with open(partFile, "rb") as f:
+                        while True:
+                            buf = f.read(1024 * 1024)
+                            if len(buf) == 0:
+                                break
+                            checker.update(buf)
+
+                size = 0
+                with open(partFile, mode) as f:
+                    while True:
+                        buf = resp.read(1024 * 1024)
+                        if len(buf) == 0:
+                            break
+                        f.write(buf)
+                        if checker is not None:
+                            checker.update(buf)
+                        size += len(buf)
+
+                # HTTPResponse.read(amt) returns b"" instead of raising exception when connection is closed prematurely
+                contentLength = resp.getheader("Content-Length")
+                if contentLength is not None and int(contentLength) != size:
+                    raise http.client.IncompleteRead(b"", int(contentLength) - size)
+
+                if checker is not None:
+                    try:
+                        checker.check(partFile)
+                    except FetchError:
+                        # corrupt part file must not be resumed
+                        os.unlink(partFile)
+                        raise
+                return
+            except BaseException:
+                conn.close()
+                conn = None
+                raise
+            finally:
+                if conn is not None:
+                    self._connPool.put(key, conn, resp)
+
+        raise FetchError("failed to download \"%s\", too many redirects" % (url))
+
+
+class _ConnectionPool:
+
+    def __init__(self, timeout):
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        self._idleDict = dict()                 # {(scheme, host, port): [conn, ...]}
+
+    def get(self, url):
+        # returns (connection, key, request-path)
+        u = urllib.parse.urlsplit(url)
+        port = u.port if u.port is not None else (443 if u.scheme == "https" else 80)
+        key = (u.scheme, u.hostname, port)
+        path = u.path if u.path != "" else "/"
+        if u.query != "":
+            path += "?" + u.query
+
+        # use proxy like wget does
+        proxy = None
+        if not urllib.request.proxy_bypass(u.hostname):
+            proxy = urllib.request.getproxies().get(u.scheme)
+        if proxy is not None and u.scheme == "http":
+            # plain http request goes to the proxy with full url
+            path = url
+
+        with self._lock:
+            connList = self._idleDict.get(key, [])
+            if len(connList) > 0:
+                return (connList.pop(), key, path)
+
+        if proxy is None:
+            if u.scheme == "https":
+                conn = http.client.HTTPSConnection(u.hostname, port, timeout=self._timeout)
+            else:
+                conn = http.client.HTTPConnection(u.hostname, port, timeout=self._timeout)
+        else:
+            pu = urllib.parse.urlsplit(proxy)
+            if u.scheme == "https":
+                conn = http.client.HTTPSConnection(pu.hostname, pu.port, timeout=self._timeout)
+                conn.set_tunnel(u.hostname, port)
+            else:
+                conn = http.client.HTTPConnection(pu.hostname, pu.port, timeout=self._timeout)
+        return (conn, key, path)
+
+    def put(self, key, conn, resp):
+        if resp.will_close:
+            conn.close()
+            return
+        with self._lock:
+            self._idleDict.setdefault(key, []).append(conn)
+
+    def close(self):
+        with self._lock:
+            for connList in self._idleDict.values():
+                for conn in connList:
+                    conn.close()
+            self._idleDict = dict()
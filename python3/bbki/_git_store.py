@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2005-2014 Fpemud <fpemud@sina.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import os
+import tarfile
+import threading
+import subprocess
+from ._util import Util
+from ._exception import FetchError
+
+
+class GitStore:
+
+    """One bare git repository holding the objects of all the git distfiles.
+       Each git distfile "git-src/<path>" is a ref "refs/bbki/<path>/HEAD" in it, so shared history is stored only once.
+       Source tree is exported by "git archive", no checkout is kept."""
+
+    # directory name in cache_distfiles_dir
+    DIR_NAME = "git-store"
+
+    RETRY_COUNT = 3
+
+    REF_PREFIX = "refs/bbki/"
+
+    # fetches into the same repository are serialized
+    _lockDict = dict()
+    _lockDictLock = threading.Lock()
+
+    def __init__(self, dirpath):
+        self._path = dirpath
+        with self._lockDictLock:
+            self._lock = self._lockDict.setdefault(os.path.realpath(dirpath), threading.Lock())
+
+    @property
+    def path(self):
+        return self._path
+
+    def exists(self):
+        return os.path.exists(os.path.join(self._path, "HEAD"))
+
+    def has_distfile(self, local_fn):
+        if not self.exists():
+            return False
+        return Util.cmdCallTestSuccess("git", "--git-dir=%s" % (self._path), "rev-parse", "--verify", "-q", self._getRef(local_fn))
+
+    def fetch(self, url, local_fn):
+        with self._lock:
+            if not self.exists():
+                os.makedirs(self._path, exist_ok=True)
+                Util.cmdCall("git", "init", "-q", "--bare", self._path)
+
+            for i in range(0, self.RETRY_COUNT):
+                try:
+                    Util.cmdCall("git", "--git-dir=%s" % (self._path), "fetch", "-q", "--no-tags", "--force", url, "+HEAD:%s" % (self._getRef(local_fn)))
+                    break
+                except subprocess.CalledProcessError as e:
+                    if i == self.RETRY_COUNT - 1:
+                        raise FetchError("failed to fetch \"%s\", %s" % (url, e.stdout.strip()))
+
+    def export(self, local_fn, target_dir):
+        # extract the source tree into target_dir, streamed from "git archive" without temporary file
+        proc = subprocess.Popen(["git", "--git-dir=%s" % (self._path), "archive", "--format=tar", self._getRef(local_fn)],
+                                stdout=subprocess.PIPE)
+        try:
+            with tarfile.open(fileobj=proc.stdout, mode="r|") as tf:
+                tf.extractall(target_dir)
+        finally:
+            proc.stdout.close()
+            proc.wait()
+        if proc.returncode != 0:
+            raise FetchError("failed to export \"%s\" from \"%s\"" % (local_fn, self._path))
+
+    def get_distfiles(self):
+        if not self.exists():
+            return []
+        out = Util.cmdCall("git", "--git-dir=%s" % (self._path), "for-each-ref", "--format=%(refname)", self.REF_PREFIX)
+        ret = []
+        for line in out.split("\n"):
+            if line.startswith(self.REF_PREFIX) and line.endswith("/HEAD"):
+                ret.append("git-src/" + line[len(self.REF_PREFIX):len("/HEAD") * -1])
+        return ret
+
+    def remove_distfiles(self, local_fn_list):
+        # objects only used by the removed distfiles are pruned
+        if len(local_fn_list) == 0:
+            return
+        with self._lock:
+            for fn in local_fn_list:
+                Util.cmdCall("git", "--git-dir=%s" % (self._path), "update-ref", "-d", self._getRef(fn))
+            Util.cmdCall("git", "--git-dir=%s" % (self._path), "gc", "-q", "--prune=now")
+
+    def _getRef(self, localFn):
+        assert localFn.startswith("git-src/")
+        return self.REF_PREFIX + localFn[len("git-src/"):].strip("/") + "/HEAD"
@@ -23,15 +23,17 @@
 
 import os
 import re
-import glob
+import stat
 import shutil
-import tarfile
+import hashlib
 import pathlib
 import anytree
 import robust_layer.simple_fops
 from ordered_set import OrderedSet
 from ._util import Util
-from ._util import TempChdir
+from ._cpio import CpioNewcWriter
+from ._initramfs_files import InitramfsFilesWriter
+from ._initramfs_compressor import InitramfsCompressor
 from ._po import HostMountPoint
 from ._po import HostDiskBtrfsRaid
 from ._po import HostDiskBcachefsRaid
@@ -48,6 +50,13 @@ from ._exception import InitramfsInstallError
 
 class InitramfsInstaller:
 
+    # number of builds kept in the initramfs cache
+    CACHE_SIZE = 4
+
+    CACHE_INITRD_FILENAME = "initramfs"
+
+    CACHE_INITRD_FILES_FILENAME = "initramfs-files.zip"
+
     def __init__(self, bbki):
         self._bbki = bbki
 
@@ -61,13 +70,16 @@ class InitramfsInstaller:
         self._initramfsTmpDir = os.path.join(self._bbki._cfg.tmp_dir, "initramfs")
 
         self._checkDotCfgFile()
+        compressor = InitramfsCompressor.new_by_kernel_config(pathlib.Path(self._be.kernel_config_filepath).read_text(),
+                                                              *self._bbki._cfg.get_initramfs_compression())
         if not os.path.exists(self._be.kernel_modules_dirpath):
             raise InitramfsInstallError("\"%s\" does not exist" % (self._be.kernel_modules_dirpath))
         if not os.path.exists(self._be.firmware_dirpath):
             raise InitramfsInstallError("\"%s\" does not exist" % (self._be.firmware_dirpath))
 
-        # prepare tmpdir
+        # prepare tmpdir, it is only used as scratch directory, initramfs content is kept in memory
         robust_layer.simple_fops.mk_empty_dir(self._initramfsTmpDir)
+        self._fileList = _InitrdFileList()
 
         # deduplicated disk list
         diskList = OrderedSet()
@@ -167,44 +179,44 @@ class InitramfsInstaller:
                     assert False
 
         # create basic structure for initramfs directory
-        self._installDir("/bin", self._initramfsTmpDir)
-        self._installDir("/dev", self._initramfsTmpDir)
-        self._installDir("/etc", self._initramfsTmpDir)
-        self._installDir("/lib", self._initramfsTmpDir)
-        self._installDir("/lib64", self._initramfsTmpDir)
-        self._installDir("/proc", self._initramfsTmpDir)
-        self._installDir("/run", self._initramfsTmpDir)
-        self._installDir("/sbin", self._initramfsTmpDir)
-        self._installDir("/sys", self._initramfsTmpDir)
-        self._installDir("/tmp", self._initramfsTmpDir)
-        self._installDir("/usr/bin", self._initramfsTmpDir)
-        self._installDir("/usr/sbin", self._initramfsTmpDir)
-        self._installDir("/usr/lib", self._initramfsTmpDir)
-        self._installDir("/usr/lib64", self._initramfsTmpDir)
-        self._installDir("/var", self._initramfsTmpDir)
-        self._installDir(self._be.kernel_modules_dirpath, self._initramfsTmpDir)
-        self._installDir(self._be.firmware_dirpath, self._initramfsTmpDir)
-        os.makedirs(os.path.join(self._initramfsTmpDir, "sysroot"))
-        self._generatePasswd(os.path.join(self._initramfsTmpDir, "etc", "passwd"))
-        self._generateGroup(os.path.join(self._initramfsTmpDir, "etc", "group"))
+        self._installDir("/bin")
+        self._installDir("/dev")
+        self._installDir("/etc")
+        self._installDir("/lib")
+        self._installDir("/lib64")
+        self._installDir("/proc")
+        self._installDir("/run")
+        self._installDir("/sbin")
+        self._installDir("/sys")
+        self._installDir("/tmp")
+        self._installDir("/usr/bin")
+        self._installDir("/usr/sbin")
+        self._installDir("/usr/lib")
+        self._installDir("/usr/lib64")
+        self._installDir("/var")
+        self._installDir(self._be.kernel_modules_dirpath)
+        self._installDir(self._be.firmware_dirpath)
+        self._fileList.add_dir("/sysroot")
+        self._generatePasswd("/etc/passwd")
+        self._generateGroup("/etc/group")
 
         # install kmod files
         for f in kmodList:
-            self._copyToInitrd(f, self._initramfsTmpDir)
+            self._copyToInitrd(f)
 
         # install firmware files
         for f in firmwareList:
-            self._copyToInitrd(f, self._initramfsTmpDir)
+            self._copyToInitrd(f)
 
         # install files for block device preparation
-        # self._installFilesBlkid(self._initramfsTmpDir)
+        # self._installFilesBlkid()
         for disk in diskList:
             if isinstance(disk, HostDiskBtrfsRaid):
                 pass
             elif isinstance(disk, HostDiskBcachefsRaid):
                 pass
             elif isinstance(disk, HostDiskLvmLv):
-                self._installFilesLvm(self._initramfsTmpDir)
+                self._installFilesLvm()
             elif isinstance(disk, HostDiskBcache):
                 pass
             elif isinstance(disk, HostDiskScsiHdd):
@@ -219,161 +231,183 @@ class InitramfsInstaller:
                 assert False
 
         # install init executable to initramfs
-        self._installInit(self._initramfsTmpDir)
-        self._installStartupRc(self._initramfsTmpDir, kmodList, blkOpList)
+        self._installInit()
+        self._installStartupRc(kmodList, blkOpList)
 
         # install kernel modules, firmwares and executables for debugging, use bash as init
         if self.trickDebug:
-            dstdir = os.path.join(self._initramfsTmpDir, self._be.kernel_modules_dirpath[1:])
-            if os.path.exists(dstdir):
-                shutil.rmtree(dstdir)
-            shutil.copytree(self._be.kernel_modules_dirpath, dstdir, symlinks=True)
-
-            dstdir = os.path.join(self._initramfsTmpDir, self._be.firmware_dirpath[1:])
-            if os.path.exists(dstdir):
-                shutil.rmtree(dstdir)
-            shutil.copytree(self._be.firmware_dirpath, dstdir, symlinks=True)
-
-            self._installBin("/bin/bash", self._initramfsTmpDir)
-            self._installBin("/bin/cat", self._initramfsTmpDir)
-            self._installBin("/bin/cp", self._initramfsTmpDir)
-            self._installBin("/bin/dd", self._initramfsTmpDir)
-            self._installBin("/bin/echo", self._initramfsTmpDir)
-            self._installBin("/bin/ls", self._initramfsTmpDir)
-            self._installBin("/bin/ln", self._initramfsTmpDir)
-            self._installBin("/bin/mount", self._initramfsTmpDir)
-            self._installBin("/bin/ps", self._initramfsTmpDir)
-            self._installBin("/bin/rm", self._initramfsTmpDir)
-            self._installBin("/bin/touch", self._initramfsTmpDir)
-            self._installBin("/usr/bin/basename", self._initramfsTmpDir)
-            self._installBin("/usr/bin/dirname", self._initramfsTmpDir)
-            self._installBin("/usr/bin/find", self._initramfsTmpDir)
-            self._installBin("/usr/bin/sleep", self._initramfsTmpDir)
-            self._installBin("/usr/bin/tree", self._initramfsTmpDir)
-            self._installBin("/usr/bin/xargs", self._initramfsTmpDir)
-            self._installBin("/usr/bin/hexdump", self._initramfsTmpDir)
-
-            self._installBin("/sbin/blkid", self._initramfsTmpDir)
-            self._installBin("/sbin/switch_root", self._initramfsTmpDir)
-
-            self._installBin("/bin/lsmod", self._initramfsTmpDir)
-            self._installBin("/bin/modinfo", self._initramfsTmpDir)
-            self._installBin("/sbin/modprobe", self._initramfsTmpDir)
-            shutil.copytree("/etc/modprobe.d", os.path.join(self._initramfsTmpDir, "etc", "modprobe.d"), symlinks=True)
-
-            self._installBin("/sbin/dmsetup", self._initramfsTmpDir)
-            self._installBin("/sbin/lvm", self._initramfsTmpDir)
+            self._fileList.add_tree(self._be.kernel_modules_dirpath)
+            self._fileList.add_tree(self._be.firmware_dirpath)
+
+            self._installBin("/bin/bash")
+            self._installBin("/bin/cat")
+            self._installBin("/bin/cp")
+            self._installBin("/bin/dd")
+            self._installBin("/bin/echo")
+            self._installBin("/bin/ls")
+            self._installBin("/bin/ln")
+            self._installBin("/bin/mount")
+            self._installBin("/bin/ps")
+            self._installBin("/bin/rm")
+            self._installBin("/bin/touch")
+            self._installBin("/usr/bin/basename")
+            self._installBin("/usr/bin/dirname")
+            self._installBin("/usr/bin/find")
+            self._installBin("/usr/bin/sleep")
+            self._installBin("/usr/bin/tree")
+            self._installBin("/usr/bin/xargs")
+            self._installBin("/usr/bin/hexdump")
+
+            self._installBin("/sbin/blkid")
+            self._installBin("/sbin/switch_root")
+
+            self._installBin("/bin/lsmod")
+            self._installBin("/bin/modinfo")
+            self._installBin("/sbin/modprobe")
+            self._fileList.add_tree("/etc/modprobe.d")
+
+            self._installBin("/sbin/dmsetup")
+            self._installBin("/sbin/lvm")
 
             if os.path.exists("/usr/bin/nano"):
-                self._installBin("/usr/bin/nano", self._initramfsTmpDir)
-
-            os.rename(os.path.join(self._initramfsTmpDir, "init"), os.path.join(self._initramfsTmpDir, "init.bak"))
-            os.symlink("/bin/bash", os.path.join(self._initramfsTmpDir, "init"))
-
-            with open(os.path.join(self._initramfsTmpDir, ".bashrc"), "w") as f:
-                f.write("echo \"<initramfs-debug> Mounting basic file systems\"\n")
-                f.write("mount -t sysfs none /sys\n")
-                f.write("mount -t proc none /proc\n")
-                f.write("mount -t devtmpfs none /dev\n")
-                f.write("\n")
-
-                f.write("echo \"<initramfs-debug> Loading all the usb drivers\"\n")
-                dstdir = os.path.join(self._be.kernel_modules_dirpath, "kernel", "drivers", "usb")
-                f.write("find \"%s\" -name \"*.ko\" | xargs basename -a -s \".ko\" | xargs /sbin/modprobe -a" % (dstdir))
-                f.write("\n")
-
-                f.write("echo \"<initramfs-debug> Loading all the hid drivers\"\n")
-                dstdir = os.path.join(self._be.kernel_modules_dirpath, "kernel", "drivers", "hid")
-                f.write("find \"%s\" -name \"*.ko\" | xargs basename -a -s \".ko\" | xargs /sbin/modprobe -a" % (dstdir))
-                f.write("\n")
-
-                f.write("echo \"<initramfs-debug> Loading all the input drivers\"\n")
-                dstdir = os.path.join(self._be.kernel_modules_dirpath, "kernel", "drivers", "input")
-                f.write("find \"%s\" -name \"*.ko\" | xargs basename -a -s \".ko\" | xargs /sbin/modprobe -a" % (dstdir))
-                f.write("\n")
-
-        # build the initramfs file and tar file
-        with TempChdir(self._initramfsTmpDir):
-            # initramfs file
-            cmdStr = "find . -print0 | cpio --null -H newc -o "
-            cmdStr += "| xz --format=lzma "            # it seems linux kernel config RD_XZ has bug, so we must use format lzma
-            cmdStr += "> \"%s\" " % (self._be.initrd_filepath)
-            Util.shellCall(cmdStr)
-
-            # tar file
-            with tarfile.open(self._be.initrd_tar_filepath, "w:bz2") as f:
-                for fn in glob.glob("*"):
-                    f.add(fn)
+                self._installBin("/usr/bin/nano")
+
+            self._fileList.rename("/init", "/init.bak")
+            self._fileList.add_symlink("/init", "/bin/bash")
+
+            buf = ""
+            buf += "echo \"<initramfs-debug> Mounting basic file systems\"\n"
+            buf += "mount -t sysfs none /sys\n"
+            buf += "mount -t proc none /proc\n"
+            buf += "mount -t devtmpfs none /dev\n"
+            buf += "\n"
+
+            buf += "echo \"<initramfs-debug> Loading all the usb drivers\"\n"
+            dstdir = os.path.join(self._be.kernel_modules_dirpath, "kernel", "drivers", "usb")
+            buf += "find \"%s\" -name \"*.ko\" | xargs basename -a -s \".ko\" | xargs /sbin/modprobe -a" % (dstdir)
+            buf += "\n"
+
+            buf += "echo \"<initramfs-debug> Loading all the hid drivers\"\n"
+            dstdir = os.path.join(self._be.kernel_modules_dirpath, "kernel", "drivers", "hid")
+            buf += "find \"%s\" -name \"*.ko\" | xargs basename -a -s \".ko\" | xargs /sbin/modprobe -a" % (dstdir)
+            buf += "\n"
+
+            buf += "echo \"<initramfs-debug> Loading all the input drivers\"\n"
+            dstdir = os.path.join(self._be.kernel_modules_dirpath, "kernel", "drivers", "input")
+            buf += "find \"%s\" -name \"*.ko\" | xargs basename -a -s \".ko\" | xargs /sbin/modprobe -a" % (dstdir)
+            buf += "\n"
+
+            self._fileList.add_data("/.bashrc", buf)
+
+        # the output is fully determined by the file list and the compressor, so a cached build with the same digest is reused
+        robust_layer.simple_fops.mkdir(self._bbki._cfg.cache_initramfs_dir)
+        cacheDir = os.path.join(self._bbki._cfg.cache_initramfs_dir, self._fileList.get_digest(compressor.name, compressor.level))
+        if not os.path.exists(cacheDir):
+            self._buildToCacheDir(compressor, cacheDir)
+        else:
+            os.utime(cacheDir)
+        shutil.copyfile(os.path.join(cacheDir, self.CACHE_INITRD_FILENAME), self._be.initrd_filepath)
+        shutil.copyfile(os.path.join(cacheDir, self.CACHE_INITRD_FILES_FILENAME), self._be.initrd_files_filepath)
+        robust_layer.simple_fops.rm(self._be.initrd_tar_filepath)
+        self._pruneCache()
+
+    def _buildToCacheDir(self, compressor, cacheDir):
+        # build in a temporary directory and rename, so that an interrupted build never leaves a broken cache entry
+        tmpCacheDir = cacheDir + ".tmp"
+        robust_layer.simple_fops.mk_empty_dir(tmpCacheDir)
+
+        # build the initramfs file, cpio archive is streamed into the compressor directly
+        with compressor.open(os.path.join(tmpCacheDir, self.CACHE_INITRD_FILENAME)) as f:
+            with CpioNewcWriter(f) as writer:
+                self._fileList.write_cpio(writer)
+
+        # build the initramfs-files archive
+        with InitramfsFilesWriter(os.path.join(tmpCacheDir, self.CACHE_INITRD_FILES_FILENAME)) as writer:
+            self._fileList.write_cpio(writer)
+
+        os.rename(tmpCacheDir, cacheDir)
+
+    def _pruneCache(self):
+        # keep only the most recently used entries
+        cacheDirList = []
+        for fn in os.listdir(self._bbki._cfg.cache_initramfs_dir):
+            fullfn = os.path.join(self._bbki._cfg.cache_initramfs_dir, fn)
+            if fn.endswith(".tmp"):
+                robust_layer.simple_fops.rm(fullfn)
+            else:
+                cacheDirList.append(fullfn)
+        cacheDirList.sort(key=lambda x: os.stat(x).st_mtime_ns, reverse=True)
+        for fullfn in cacheDirList[self.CACHE_SIZE:]:
+            robust_layer.simple_fops.rm(fullfn)
 
     def _generatePasswd(self, filename):
-        with open(filename, "w") as f:
-            f.write("root:x:0:0::/root:/bin/sh\n")
-            f.write("nobody:x:65534:65534::/:/sbin/nologin\n")
+        buf = ""
+        buf += "root:x:0:0::/root:/bin/sh\n"
+        buf += "nobody:x:65534:65534::/:/sbin/nologin\n"
+        self._fileList.add_data(filename, buf)
 
     def _generateGroup(self, filename):
-        with open(filename, "w") as f:
-            f.write("tty:x:5:\n")
-            f.write("kmem:x:9:\n")
-            f.write("disk:x:6:adm\n")
-            f.write("floppy:x:11:\n")
-            f.write("cdrom:x:19:\n")
-
-    def _installDir(self, dirFilename, rootDir):
+        buf = ""
+        buf += "tty:x:5:\n"
+        buf += "kmem:x:9:\n"
+        buf += "disk:x:6:adm\n"
+        buf += "floppy:x:11:\n"
+        buf += "cdrom:x:19:\n"
+        self._fileList.add_data(filename, buf)
+
+    def _installDir(self, dirFilename):
         assert dirFilename.startswith("/")
 
         if not os.path.isdir(dirFilename):
             raise Exception("\"%s\" is not a directory" % (dirFilename))
 
-        dstDir = rootDir + dirFilename
         if os.path.islink(dirFilename):
-            dirname = os.path.dirname(dstDir)
-            if not os.path.exists(dirname):
-                os.makedirs(dirname)
-            os.symlink(os.readlink(dirFilename), dstDir)
+            self._fileList.add_symlink(dirFilename, os.readlink(dirFilename))
         else:
-            os.makedirs(dstDir)
+            self._fileList.add_dir(dirFilename)
 
-    def _installBin(self, binFilename, rootDir):
-        self._copyToInitrd(binFilename, rootDir)
+    def _installBin(self, binFilename):
+        self._copyToInitrd(binFilename)
         for df in Util.libUsed(binFilename):
-            self._copyToInitrd(df, rootDir)
+            self._copyToInitrd(df)
 
-    def _installBinFromInitDataDir(self, binFilename, rootDir, targetDir):
+    def _installBinFromInitDataDir(self, binFilename, targetDir):
         srcFilename = os.path.join(self._trWorkDir, binFilename)
-        dstFilename = os.path.join(rootDir, targetDir, binFilename)
+        dstFilename = os.path.join("/", targetDir, binFilename)
 
-        Util.cmdCall("/bin/cp", "-f", srcFilename, dstFilename)
-        Util.cmdCall("/bin/chmod", "755", dstFilename)
+        self._fileList.add_file(dstFilename, srcFilename, mode=0o755)
 
-        for df in Util.libUsed(dstFilename):
-            self._copyToInitrd(df, rootDir)
+        for df in Util.libUsed(srcFilename):
+            self._copyToInitrd(df)
 
-    def _installFilesLvm(self, rootDir):
-        self._installBin("/sbin/lvm", self._initramfsTmpDir)
+    def _installFilesLvm(self):
+        self._installBin("/sbin/lvm")
 
+        # systemd-tmpfiles needs a real directory, so it runs in the scratch directory whose content is then added to file list
         # note: surrounded " would be recognized as part of rootDir, it's a bug of systemd-tmpfiles
+        rootDir = os.path.join(self._initramfsTmpDir, "lvm2")
+        robust_layer.simple_fops.mk_empty_dir(rootDir)
         Util.cmdCall("/bin/systemd-tmpfiles", "--create", "--root=%s" % (rootDir), "/usr/lib/tmpfiles.d/lvm2.conf")
+        self._fileList.add_tree(rootDir, "/")
 
-        etcDir = os.path.join(rootDir, "etc", "lvm")
-        if not os.path.exists(etcDir):
-            os.mkdir(etcDir)
-        with open(os.path.join(etcDir, "lvm.conf"), "w") as f:
-            f.write("global {\n")
-            f.write("    locking_type = 4\n")
-            f.write("    use_lvmetad = 0\n")
-            f.write("}\n")
-            f.write("devices {\n")
-            f.write("    write_cache_state = 0\n")
-            f.write("}\n")
-            f.write("backup {\n")
-            f.write("    backup = 0\n")
-            f.write("    archive = 0\n")
-            f.write("}\n")
-
-    def _installInit(self, rootDir):
-        self._installBinFromInitDataDir("init", rootDir, "")
-
-    def _installStartupRc(self, rootDir, kmodList, blkOpList):
+        buf = ""
+        buf += "global {\n"
+        buf += "    locking_type = 4\n"
+        buf += "    use_lvmetad = 0\n"
+        buf += "}\n"
+        buf += "devices {\n"
+        buf += "    write_cache_state = 0\n"
+        buf += "}\n"
+        buf += "backup {\n"
+        buf += "    backup = 0\n"
+        buf += "    archive = 0\n"
+        buf += "}\n"
+        self._fileList.add_data("/etc/lvm/lvm.conf", buf)
+
+    def _installInit(self):
+        self._installBinFromInitDataDir("init", "")
+
+    def _installStartupRc(self, kmodList, blkOpList):
         buf = ""
 
         def _getPrefixedMountPoint(mount_point):
@@ -426,42 +460,31 @@ class InitramfsInstaller:
         buf += "\n"
 
         # write cfg file
-        with open(os.path.join(rootDir, "startup.rc"), "w") as f:
-            f.write(buf)
+        self._fileList.add_data("/startup.rc", buf)
 
-    def _copyToInitrd(self, filename, rootDir):
+    def _copyToInitrd(self, filename):
         assert os.path.isabs(filename)
         while True:
             if os.path.islink(filename):
-                self._copyToInitrdImplLink(filename, rootDir)
+                self._copyToInitrdImplLink(filename)
                 filename = os.path.join(os.path.dirname(filename), os.readlink(filename))
             else:
-                self._copyToInitrdImplFile(filename, rootDir)
+                self._copyToInitrdImplFile(filename)
                 break
 
-    def _copyToInitrdImplLink(self, filename, rootDir):
-        dstfile = os.path.join(rootDir, filename[1:])
-        if os.path.exists(dstfile):
+    def _copyToInitrdImplLink(self, filename):
+        if self._fileList.exists(filename):
             return
-        dstdir = os.path.dirname(dstfile)
-        if not os.path.exists(dstdir):
-            os.makedirs(dstdir)
-        linkto = os.readlink(filename)
-        os.symlink(linkto, dstfile)
-
-    def _copyToInitrdImplFile(self, filename, rootDir):
-        dstfile = os.path.join(rootDir, filename[1:])
-        if os.path.exists(dstfile):
+        self._fileList.add_symlink(filename, os.readlink(filename))
+
+    def _copyToInitrdImplFile(self, filename):
+        if self._fileList.exists(filename):
             return
-        dstdir = os.path.dirname(dstfile)
-        if not os.path.exists(dstdir):
-            os.makedirs(dstdir)
-        Util.cmdCall("/bin/cp", "-f", filename, dstfile)
+        self._fileList.add_file(filename, filename)
 
     def _checkDotCfgFile(self):
+        # config symbol for initramfs compressor is checked when selecting compressor
         symDict = {
-            "RD_XZ": "y",
-            "RD_LZMA": "y",         # it seems RD_XZ has no effect, we have to enable RD_LZMA, kernel bug?
             "BCACHE": "m",
             "BLK_DEV_SD": "m",
             "BLK_DEV_DM": "m",
@@ -473,3 +496,137 @@ class InitramfsInstaller:
         for k, v in symDict.items():
             if not re.search("^CONFIG_%s=%s$" % (k, v), buf, re.M):
                 raise InitramfsInstallError("config symbol %s must be selected as \"%s\"!" % (k, v))
+
+
+class _InitrdFileList:
+
+    """Content of the initramfs, kept in memory and written to archives directly.
+       Entries are kept in insertion order, parent directories are always added before their children.
+       Symlinks in parent path are followed like what the kernel does when extracting the archive."""
+
+    TYPE_DIR = "dir"
+    TYPE_FILE = "file"            # content comes from a host file
+    TYPE_DATA = "data"            # content comes from memory
+    TYPE_SYMLINK = "symlink"
+
+    def __init__(self):
+        self._entryDict = dict()            # {path: (type, mode, host-filepath or data or symlink-target)}
+
+    def exists(self, path):
+        return self._resolve(path) in self._entryDict
+
+    def add_dir(self, path, mode=0o755):
+        path = self._resolve(path)
+        if path == "/" or path in self._entryDict:
+            return
+        self._addParentDirs(path)
+        self._entryDict[path] = (self.TYPE_DIR, mode, None)
+
+    def add_file(self, path, filepath, mode=None):
+        if mode is None:
+            mode = stat.S_IMODE(os.stat(filepath).st_mode)
+        self._addLeaf(path, (self.TYPE_FILE, mode, filepath))
+
+    def add_data(self, path, data, mode=0o644):
+        # existing entry is replaced
+        self._addLeaf(path, (self.TYPE_DATA, mode, data.encode("utf-8") if isinstance(data, str) else data))
+
+    def add_symlink(self, path, target):
+        self._addLeaf(path, (self.TYPE_SYMLINK, 0o777, target))
+
+    def add_tree(self, dirpath, target_dirpath=None):
+        # add all the content in a host directory recursively, symlinks are not followed
+        if target_dirpath is None:
+            target_dirpath = dirpath
+        for root, dirs, files in os.walk(dirpath):
+            for fn in sorted(dirs) + sorted(files):
+                fullfn = os.path.join(root, fn)
+                path = os.path.join(target_dirpath, os.path.relpath(fullfn, dirpath))
+                if os.path.islink(fullfn):
+                    if not self.exists(path):
+                        self.add_symlink(path, os.readlink(fullfn))
+                elif os.path.isdir(fullfn):
+                    self.add_dir(path, stat.S_IMODE(os.stat(fullfn).st_mode))
+                elif not self.exists(path):
+                    self.add_file(path, fullfn)
+            dirs.sort()
+
+    def get_digest(self, *extra_args):
+        # digest of all the entries, including content of host files, extra_args are the other factors affecting the output
+        h = hashlib.sha256()
+        h.update(repr(extra_args).encode("utf-8"))
+        for path, (t, mode, value) in self._entryDict.items():
+            h.update(repr((path, t, mode)).encode("utf-8"))
+            if t == self.TYPE_DIR:
+                pass
+            elif t == self.TYPE_FILE:
+                h.update(repr(os.path.getsize(value)).encode("utf-8"))
+                with open(value, "rb") as f:
+                    while True:
+                        buf = f.read(1024 * 1024)
+                        if len(buf) == 0:
+                            break
+                        h.update(buf)
+            elif t == self.TYPE_DATA:
+                h.update(repr(len(value)).encode("utf-8"))
+                h.update(value)
+            elif t == self.TYPE_SYMLINK:
+                h.update(repr(value).encode("utf-8"))
+            else:
+                assert False
+        return h.hexdigest()
+
+    def rename(self, path, new_path):
+        path = self._resolve(path)
+        self._addLeaf(new_path, self._entryDict.pop(path))
+
+    def write_cpio(self, writer):
+        # writer can be CpioNewcWriter or InitramfsFilesWriter, they have the same interface
+        for path, (t, mode, value) in self._entryDict.items():
+            if t == self.TYPE_DIR:
+                writer.add_directory(path, mode)
+            elif t == self.TYPE_FILE:
+                writer.add_file(path, value, mode)
+            elif t == self.TYPE_DATA:
+                writer.add_data(path, value, mode)
+            elif t == self.TYPE_SYMLINK:
+                writer.add_symlink(path, value)
+            else:
+                assert False
+
+    def _addLeaf(self, path, entry):
+        path = os.path.join(self._resolve(os.path.dirname(path)), os.path.basename(path))
+        self._addParentDirs(path)
+        self._entryDict[path] = entry
+
+    def _addParentDirs(self, path):
+        dirpath = os.path.dirname(path)
+        if dirpath != "/" and dirpath not in self._entryDict:
+            self.add_dir(dirpath)
+
+    def _resolve(self, path):
+        # follow symlinks in the path (including the last component), returns normalized absolute path
+        assert os.path.isabs(path)
+
+        ret = "/"
+        partList = [x for x in path.split("/") if x != ""]
+        count = 0
+        while len(partList) > 0:
+            part = partList.pop(0)
+            if part == ".":
+                continue
+            if part == "..":
+                ret = os.path.dirname(ret)
+                continue
+            cur = os.path.join(ret, part)
+            entry = self._entryDict.get(cur)
+            if entry is not None and entry[0] == self.TYPE_SYMLINK:
+                count += 1
+                if count > 40:
+                    raise Exception("too many levels of symbolic links in \"%s\"" % (path))
+                if entry[2].startswith("/"):
+                    ret = "/"
+                partList = [x for x in entry[2].split("/") if x != ""] + partList
+            else:
+                ret = cur
+        return ret
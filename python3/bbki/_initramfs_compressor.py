@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2005-2014 Fpemud <fpemud@sina.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import re
+import gzip
+import lzma
+import contextlib
+import subprocess
+from ._exception import InitramfsInstallError
+
+
+class InitramfsCompressor:
+
+    # name used in bbki.options
+    NAME = None
+
+    # the kernel must have this config symbol selected to decompress the initramfs
+    KERNEL_CONFIG_SYMBOL = None
+
+    # (minimum, maximum) of compression level
+    LEVEL_RANGE = None
+
+    @staticmethod
+    def get_compressor_names():
+        return [x.NAME for x in _compressorList]
+
+    @staticmethod
+    def get_level_range(name):
+        # name can be "auto", then the returned range is valid for all the compressors
+        if name == "auto":
+            return (max([x.LEVEL_RANGE[0] for x in _compressorList]), min([x.LEVEL_RANGE[1] for x in _compressorList]))
+        for klass in _compressorList:
+            if klass.NAME == name:
+                return klass.LEVEL_RANGE
+        raise InitramfsInstallError("invalid initramfs compressor \"%s\"" % (name))
+
+    @staticmethod
+    def new(name, level=None, threads=0):
+        # level: None means the default level of the compressor
+        # threads: 0 means using all the CPUs, only meaningful for compressors which support multi-threading
+        for klass in _compressorList:
+            if klass.NAME == name:
+                return klass(level, threads)
+        raise InitramfsInstallError("invalid initramfs compressor \"%s\"" % (name))
+
+    @staticmethod
+    def new_by_kernel_config(kernel_config_buf, name="auto", level=None, threads=0):
+        if name == "auto":
+            # it seems linux kernel config RD_XZ has bug, so xz has the lowest priority
+            for klass in _compressorList:
+                if _isSymbolSelected(kernel_config_buf, klass.KERNEL_CONFIG_SYMBOL):
+                    return klass(level, threads)
+            raise InitramfsInstallError("no initramfs compressor is supported by kernel")
+        else:
+            ret = InitramfsCompressor.new(name, level, threads)
+            if not _isSymbolSelected(kernel_config_buf, ret.KERNEL_CONFIG_SYMBOL):
+                raise InitramfsInstallError("config symbol %s must be selected as \"y\" to use initramfs compressor \"%s\"!" % (ret.KERNEL_CONFIG_SYMBOL, name))
+            return ret
+
+    def __init__(self, level, threads):
+        if level is not None and not (self.LEVEL_RANGE[0] <= level <= self.LEVEL_RANGE[1]):
+            raise InitramfsInstallError("invalid compression level %d for initramfs compressor \"%s\"" % (level, self.NAME))
+        self._level = level
+        self._threads = threads
+
+    @property
+    def name(self):
+        return self.NAME
+
+    @property
+    def level(self):
+        # None means the default level of the compressor
+        return self._level
+
+    def open(self, filepath):
+        # returns a context manager which gives a writable file object
+        raise NotImplementedError()
+
+
+class InitramfsCompressorZstd(InitramfsCompressor):
+
+    NAME = "zstd"
+
+    KERNEL_CONFIG_SYMBOL = "RD_ZSTD"
+
+    LEVEL_RANGE = (1, 22)
+
+    def open(self, filepath):
+        cmdList = ["zstd", "-q", "-c", "-T%d" % (self._threads)]
+        if self._level is not None:
+            if self._level > 19:
+                cmdList.append("--ultra")
+            cmdList.append("-%d" % (self._level))
+        return _compressByCmd(cmdList, filepath)
+
+
+class InitramfsCompressorLzma(InitramfsCompressor):
+
+    NAME = "lzma"
+
+    KERNEL_CONFIG_SYMBOL = "RD_LZMA"
+
+    LEVEL_RANGE = (0, 9)
+
+    def open(self, filepath):
+        # same as "xz --format=lzma", single-threaded
+        preset = self._level if self._level is not None else lzma.PRESET_DEFAULT
+        return lzma.open(filepath, "wb", format=lzma.FORMAT_ALONE, preset=preset)
+
+
+class InitramfsCompressorGzip(InitramfsCompressor):
+
+    NAME = "gzip"
+
+    KERNEL_CONFIG_SYMBOL = "RD_GZIP"
+
+    LEVEL_RANGE = (0, 9)
+
+    def open(self, filepath):
+        # mtime is fixed, so that the initramfs file is reproducible
+        level = self._level if self._level is not None else 9
+        return gzip.GzipFile(filepath, "wb", compresslevel=level, mtime=0)
+
+
+class InitramfsCompressorLz4(InitramfsCompressor):
+
+    NAME = "lz4"
+
+    KERNEL_CONFIG_SYMBOL = "RD_LZ4"
+
+    LEVEL_RANGE = (1, 12)
+
+    def open(self, filepath):
+        # linux kernel only supports lz4 legacy format
+        cmdList = ["lz4", "-q", "-c", "-l"]
+        if self._level is not None:
+            cmdList.append("-%d" % (self._level))
+        return _compressByCmd(cmdList, filepath)
+
+
+class InitramfsCompressorXz(InitramfsCompressor):
+
+    NAME = "xz"
+
+    KERNEL_CONFIG_SYMBOL = "RD_XZ"
+
+    LEVEL_RANGE = (0, 9)
+
+    def open(self, filepath):
+        # linux kernel only supports crc32 integrity check
+        cmdList = ["xz", "-q", "-c", "--check=crc32", "-T%d" % (self._threads)]
+        if self._level is not None:
+            cmdList.append("-%d" % (self._level))
+        return _compressByCmd(cmdList, filepath)
+
+
+# order is important, it is used as priority when auto selecting compressor
+_compressorList = [
+    InitramfsCompressorZstd,
+    InitramfsCompressorLzma,
+    InitramfsCompressorGzip,
+    InitramfsCompressorLz4,
+    InitramfsCompressorXz,
+]
+
+
+def _isSymbolSelected(kernelConfigBuf, symbol):
+    return re.search("^CONFIG_%s=y$" % (symbol), kernelConfigBuf, re.M) is not None
+
+
+@contextlib.contextmanager
+def _compressByCmd(cmdList, filepath):
+    with open(filepath, "wb") as f:
+        proc = subprocess.Popen(cmdList, stdin=subprocess.PIPE, stdout=f)
+        try:
+            yield proc.stdin
+        finally:
+            proc.stdin.close()
+            proc.wait()
+    if proc.returncode != 0:
+        raise InitramfsInstallError("\"%s\" failed with exit code %d" % (" ".join(cmdList), proc.returncode))
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2005-2014 Fpemud <fpemud@sina.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import os
+import stat
+import shutil
+import tarfile
+import zipfile
+
+
+class InitramfsFilesWriter:
+
+    """Writes the initramfs-files archive.
+       It is a zip file, every member is compressed seperately and the central directory is an index,
+       so that listing or extracting a single file needs not to decompress the whole archive.
+       Symlinks are stored as members with S_IFLNK mode whose content is the link target."""
+
+    def __init__(self, filepath):
+        self._zf = zipfile.ZipFile(filepath, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=6)
+
+    def add_directory(self, name, mode=0o755):
+        self._zf.writestr(self._newInfo(name.rstrip("/") + "/", stat.S_IFDIR | mode), b"")
+
+    def add_symlink(self, name, target):
+        self._zf.writestr(self._newInfo(name, stat.S_IFLNK | 0o777, zipfile.ZIP_STORED), target.encode("utf-8"))
+
+    def add_data(self, name, data, mode=0o644):
+        self._zf.writestr(self._newInfo(name, stat.S_IFREG | mode), data)
+
+    def add_file(self, name, filepath, mode=None):
+        if mode is None:
+            mode = stat.S_IMODE(os.stat(filepath).st_mode)
+        with open(filepath, "rb") as src, self._zf.open(self._newInfo(name, stat.S_IFREG | mode), "w") as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+
+    def close(self):
+        self._zf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def _newInfo(self, name, mode, compressType=zipfile.ZIP_DEFLATED):
+        # date_time is fixed, so that the archive is reproducible
+        ret = zipfile.ZipInfo(name.lstrip("/"), date_time=(1980, 1, 1, 0, 0, 0))
+        ret.external_attr = mode << 16
+        ret.create_system = 3                   # unix
+        ret.compress_type = compressType
+        return ret
+
+
+class InitramfsFilesReader:
+
+    """Reads the initramfs-files archive, supports the zip format and the legacy tar.bz2 format.
+       Reading single file from the legacy format needs decompressing all the data before it."""
+
+    def __init__(self, filepath):
+        self._zf = None
+        self._tf = None
+        if filepath.endswith(".zip"):
+            self._zf = zipfile.ZipFile(filepath, "r")
+        elif filepath.endswith(".tar.bz2"):
+            self._tf = tarfile.open(filepath, "r:bz2")
+        else:
+            raise ValueError("\"%s\" has unknown format" % (filepath))
+
+    def get_filenames(self):
+        # directories end with "/"
+        if self._zf is not None:
+            return self._zf.namelist()
+        else:
+            return [x.name + "/" if x.isdir() else x.name for x in self._tf.getmembers()]
+
+    def is_symlink(self, filename):
+        if self._zf is not None:
+            return stat.S_ISLNK(self._zf.getinfo(filename).external_attr >> 16)
+        else:
+            return self._tf.getmember(filename).issym()
+
+    def read_file(self, filename):
+        # returns file content as bytes, returns link target for symlink
+        if self._zf is not None:
+            return self._zf.read(filename)
+        else:
+            ti = self._tf.getmember(filename)
+            if ti.issym():
+                return ti.linkname.encode("utf-8")
+            return self._tf.extractfile(ti).read()
+
+    def extract_file(self, filename, target_dir):
+        # returns path of the extracted file
+        dstFn = os.path.join(target_dir, filename)
+        os.makedirs(os.path.dirname(dstFn), exist_ok=True)
+        if self.is_symlink(filename):
+            os.symlink(self.read_file(filename).decode("utf-8"), dstFn)
+        elif self._zf is not None:
+            mode = stat.S_IMODE(self._zf.getinfo(filename).external_attr >> 16)
+            with self._zf.open(filename, "r") as src, open(dstFn, "wb") as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+            os.chmod(dstFn, mode)
+        else:
+            self._tf.extract(filename, target_dir, set_attrs=False)
+        return dstFn
+
+    def close(self):
+        if self._zf is not None:
+            self._zf.close()
+        else:
+            self._tf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
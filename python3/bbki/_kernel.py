@@ -23,7 +23,13 @@
 
 import os
 import re
+import json
+import time
+import hashlib
+import pathlib
 import platform
+import threading
+import concurrent.futures
 import pylkcutil
 import pkg_resources
 import robust_layer.simple_fops
@@ -40,6 +46,7 @@ def Step(progress_step):
             assert self._progress == progress_step
             func(self)
             self._progress += 1
+            self._saveCheckpoint()
         return wrapper
     return decorator
 
@@ -54,11 +61,10 @@ class KernelInstallProgress:
 
     def __init__(self, parent):
         self._parent = parent
-        self._progress = self.STEP_INIT
 
     @property
     def progress(self):
-        return self._progress
+        return self._parent._progress
 
     @property
     def target_boot_entry(self):
@@ -74,6 +80,16 @@ class KernelInstallProgress:
         assert self._parent._kcfgRulesTmpFile is not None
         return self._parent._kcfgRulesTmpFile
 
+    @property
+    def makeopts(self):
+        # MAKEOPTS used by the install step, derived automatically if it is not specified in make.conf
+        return self._parent._makeOpts
+
+    @property
+    def compiler_cache_stats(self):
+        # returns (hits, misses) of the compiler cache in the install step, returns None if compiler cache is not used
+        return self._parent._compilerCacheStats
+
     @property
     def kernel_source_signature(self):
         # FIXME
@@ -82,6 +98,10 @@ class KernelInstallProgress:
 
 class KernelInstaller:
 
+    KBUILD_STAMP_FILENAME = ".bbki-stamp"
+
+    CHECKPOINT_FORMAT = 1
+
     def __init__(self, bbki, kernel_atom, kernel_atom_item_list, initramfs_atom):
         self._bbki = bbki
 
@@ -90,19 +110,56 @@ class KernelInstaller:
         self._initramfsAtom = initramfs_atom
 
         self._executorDict = dict()
-        self._executorDict[kernel_atom] = BbkiAtomExecutor(self._bbki, kernel_atom)
+        self._executorDict[kernel_atom] = BbkiAtomExecutor(self._bbki, kernel_atom, use_coprocess=True)
         for item in kernel_atom_item_list:
-            self._executorDict[item] = BbkiAtomExecutor(self._bbki, item)
+            self._executorDict[item] = BbkiAtomExecutor(self._bbki, item, use_coprocess=True)
         if self._initramfsAtom is not None:
-            self._executorDict[self._initramfsAtom] = BbkiAtomExecutor(self._bbki, self._initramfsAtom)
+            self._executorDict[self._initramfsAtom] = BbkiAtomExecutor(self._bbki, self._initramfsAtom, use_coprocess=True)
 
         self._progress = KernelInstallProgress.STEP_INIT
         self._targetBootEntry = None
+        self._compilerCacheStats = None
+        self._makeOpts = self._bbki._getMakeOpts()
 
         self._myTmpDir = os.path.join(self._bbki._cfg.tmp_dir, "kernel")
         self._kcfgRulesTmpFile = os.path.join(self._myTmpDir, "config.rules")
         self._dotCfgFile = os.path.join(self._myTmpDir, "config")
+        self._checkpointFile = os.path.join(self._myTmpDir, "checkpoint.json")
+
+    def get_progress(self):
+        return KernelInstallProgress(self)
 
+    def resume(self):
+        # continue the installation left by a previous KernelInstaller object from its last completed step
+        # raises KernelInstallError if there's no checkpoint, or the checkpoint does not match the atoms or the files on disk
+        assert self._progress == KernelInstallProgress.STEP_INIT
+
+        try:
+            with open(self._checkpointFile, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            raise KernelInstallError("no valid checkpoint found")
+        if data.get("format") != self.CHECKPOINT_FORMAT:
+            raise KernelInstallError("no valid checkpoint found")
+        if data["atoms"] != self._getCheckpointAtoms():
+            raise KernelInstallError("checkpoint is not for the specified atoms")
+        if data["fingerprint"] != self._getCheckpointFingerprint(data["time"]):
+            raise KernelInstallError("files are changed since checkpoint")
+
+        self._progress = data["progress"]
+        self._targetBootEntry = BootEntry(self._bbki, data["target_boot_entry"][0], data["target_boot_entry"][1])
+
+        stepList = [
+            self.unpack,
+            self.patch_kernel,
+            self.generate_kernel_config_file,
+            self.install,
+        ]
+        for step in stepList[self._progress - KernelInstallProgress.STEP_INIT:]:
+            step()
+
+    @Step(KernelInstallProgress.STEP_INIT)
+    def unpack(self):
         # create tmpdirs
         robust_layer.simple_fops.mk_empty_dir(self._myTmpDir)
         self._executorDict[self._kernelAtom].create_tmpdirs()
@@ -111,16 +168,12 @@ class KernelInstaller:
         if self._initramfsAtom is not None:
             self._executorDict[self._initramfsAtom].create_tmpdirs()
 
-    def get_progress(self):
-        return KernelInstallProgress(self)
-
-    @Step(KernelInstallProgress.STEP_INIT)
-    def unpack(self):
-        self._executorDict[self._kernelAtom].exec_src_unpack()
-        for item in self._addonAtomList:
-            self._executorDict[item].exec_src_unpack()
-        if self._initramfsAtom is not None:
-            self._executorDict[self._initramfsAtom].exec_src_unpack()
+        # atoms are unpacked concurrently into their own work directories, most of the time is spent in sub-processes and I/O
+        with concurrent.futures.ThreadPoolExecutor(len(self._executorDict)) as executor:
+            futureList = [executor.submit(x.exec_src_unpack) for x in self._executorDict.values()]
+            concurrent.futures.wait(futureList)
+        for f in futureList:
+            f.result()                      # raise the first exception
 
         self._targetBootEntry = BootEntry(self._bbki, platform.machine(), _getKernelVerStr((self._executorDict[self._kernelAtom].get_work_dir())))
 
@@ -230,9 +283,18 @@ class KernelInstaller:
 
     @Step(KernelInstallProgress.STEP_KERNEL_CONFIG_FILE_GENERATED)
     def install(self):
-        self._executorDict[self._kernelAtom].exec_kernel_install(self._dotCfgFile, self._kcfgRulesTmpFile, self._targetBootEntry)
-        for item in self._addonAtomList:
-            self._executorDict[item].exec_kernel_addon_install(self._kernelAtom, self._targetBootEntry)
+        compilerCache = self._bbki._compilerCache
+        if compilerCache is not None:
+            statsBegin = compilerCache.get_stats()
+
+        self._prepareKbuildDir()
+        self._executorDict[self._kernelAtom].exec_kernel_install(self._dotCfgFile, self._kcfgRulesTmpFile, self._targetBootEntry, self._makeOpts)
+        self._installAddons()
+
+        if compilerCache is not None:
+            statsEnd = compilerCache.get_stats()
+            if statsBegin is not None and statsEnd is not None:
+                self._compilerCacheStats = (statsEnd[0] - statsBegin[0], statsEnd[1] - statsBegin[1])
 
         for be in self._bbki.get_boot_entries():
             if be != self._targetBootEntry:
@@ -242,7 +304,15 @@ class KernelInstaller:
         for item in self._addonAtomList:
             self._executorDict[item].exec_kernel_addon_cleanup()
 
-    def dispose(self):
+        # build firmware index, so that firmware querying needs not to scan all the kernel modules
+        BootEntryWrapper(self._targetBootEntry).update_firmware_index()
+
+    def dispose(self, keep_checkpoint=False):
+        # keep_checkpoint: keep temporary files for resume() if installation is not completed
+        for executor in self._executorDict.values():
+            executor.dispose()
+        if keep_checkpoint and self._progress < KernelInstallProgress.STEP_KERNEL_INSTALLED and os.path.exists(self._checkpointFile):
+            return
         if self._initramfsAtom is not None:
             self._executorDict[self._initramfsAtom].remove_tmpdirs()
         for item in reversed(self._addonAtomList):
@@ -250,6 +320,134 @@ class KernelInstaller:
         self._executorDict[self._kernelAtom].remove_tmpdirs()
         robust_layer.simple_fops.rm(self._myTmpDir)
 
+    def _installAddons(self):
+        # addons depend only on the built kernel, unless they specify other addons in variable ADDON_DEPEND
+        # independent addons are built concurrently (kernel_addon_build), the job count in MAKEOPTS is divided among them
+        # kernel_addon_install is serialized, since it writes into the shared kernel modules directory, runs depmod and scans
+        # all the kernel modules for firmwares, so an addon which does everything in kernel_addon_install is not parallelized
+        dependDict = dict()
+        for item in self._addonAtomList:
+            executor = self._executorDict[item]
+            nameList = executor.get_variable("ADDON_DEPEND").split() if executor.has_variable("ADDON_DEPEND") else []
+            dependDict[item] = [x for x in self._addonAtomList if x.name in nameList]           # not selected addons are ignored
+            if item in dependDict[item]:
+                raise KernelInstallError("kernel addon \"%s\" depends on itself" % (item.name))
+
+        parallelCount, makeOpts = _splitMakeOpts(self._makeOpts, len(self._addonAtomList))
+        if parallelCount == 0:
+            return
+
+        installLock = threading.Lock()
+
+        def __buildAndInstall(item):
+            self._executorDict[item].exec_kernel_addon_build(self._kernelAtom, self._targetBootEntry, makeOpts)
+            with installLock:
+                self._executorDict[item].exec_kernel_addon_install(self._kernelAtom, self._targetBootEntry, self._makeOpts)
+
+        doneSet = set()
+        runningDict = dict()                                # {future: atom}
+        firstException = None
+        with concurrent.futures.ThreadPoolExecutor(parallelCount) as pool:
+            while True:
+                if firstException is None:
+                    for item in self._addonAtomList:
+                        if len(runningDict) >= parallelCount:
+                            break
+                        if item in doneSet or item in runningDict.values():
+                            continue
+                        if all([x in doneSet for x in dependDict[item]]):
+                            f = pool.submit(__buildAndInstall, item)
+                            runningDict[f] = item
+                if len(runningDict) == 0:
+                    break
+                finishedSet, dummy = concurrent.futures.wait(runningDict, return_when=concurrent.futures.FIRST_COMPLETED)
+                for f in finishedSet:
+                    item = runningDict.pop(f)
+                    if f.exception() is not None:
+                        # no new addon is started, wait for the running ones
+                        if firstException is None:
+                            firstException = f.exception()
+                    else:
+                        doneSet.add(item)
+
+        if firstException is not None:
+            raise firstException
+        if len(doneSet) < len(self._addonAtomList):
+            raise KernelInstallError("circular dependency among kernel addons %s" % (", ".join([x.name for x in self._addonAtomList if x not in doneSet])))
+
+    def _saveCheckpoint(self):
+        # files written before this time are recorded in fingerprint
+        t = time.time_ns()
+        data = {
+            "format": self.CHECKPOINT_FORMAT,
+            "progress": self._progress,
+            "atoms": self._getCheckpointAtoms(),
+            "target_boot_entry": [self._targetBootEntry.arch, self._targetBootEntry.verstr],
+            "time": t,
+            "fingerprint": self._getCheckpointFingerprint(t),
+        }
+        Util.writeJsonFile(self._checkpointFile, data)
+
+    def _getCheckpointAtoms(self):
+        ret = [self._kernelAtom] + self._addonAtomList
+        if self._initramfsAtom is not None:
+            ret.append(self._initramfsAtom)
+        return ["%s-%s" % (x.fullname, x.verstr) for x in ret]
+
+    def _getCheckpointFingerprint(self, t):
+        # files written after checkpoint (eg. object files of an interrupted build) are ignored
+        # files which exist at checkpoint must be unchanged
+        dirList = [self._myTmpDir] + [self._executorDict[x].get_work_dir() for x in [self._kernelAtom] + self._addonAtomList]
+        if self._initramfsAtom is not None:
+            dirList.append(self._executorDict[self._initramfsAtom].get_work_dir())
+
+        h = hashlib.sha256()
+        for dirpath in dirList:
+            for root, dirs, files in os.walk(dirpath):
+                dirs.sort()
+                for fn in sorted(files):
+                    fullfn = os.path.join(root, fn)
+                    if fullfn.startswith(self._checkpointFile):
+                        continue
+                    st = os.lstat(fullfn)
+                    if st.st_mtime_ns <= t:
+                        h.update(("%s %d %d\n" % (fullfn, st.st_size, st.st_mtime_ns)).encode("utf-8", "surrogateescape"))
+        return h.hexdigest()
+
+    def _prepareKbuildDir(self):
+        # build directory is kept for incremental build, kbuild rebuilds only what changed in config and source files
+        # it is cleaned when the kernel source version or the addon set changes, since an addon may patch the kernel source
+        # and a reverted patch restores the old mtime of the source file, which kbuild would not notice
+        dirpath = self._executorDict[self._kernelAtom].get_kbuild_dir()
+        if dirpath is None:
+            return
+
+        stampFile = os.path.join(dirpath, self.KBUILD_STAMP_FILENAME)
+        stamp = "%s %s %s\n" % (self._kernelAtom.verstr, self._targetBootEntry.arch, self._targetBootEntry.verstr)
+        stamp += "".join(sorted(["%s-%s\n" % (x.fullname, x.verstr) for x in self._addonAtomList]))
+        if os.path.exists(stampFile) and pathlib.Path(stampFile).read_text() == stamp:
+            return
+
+        os.makedirs(os.path.dirname(dirpath), exist_ok=True)
+        robust_layer.simple_fops.mk_empty_dir(dirpath)
+        with open(stampFile, "w") as f:
+            f.write(stamp)
+
+
+def _splitMakeOpts(makeOpts, count):
+    # returns (parallel-count, makeopts-for-each)
+    # job count is divided so that the total job count is not exceeded, "--load-average" is kept as is
+    if count == 0:
+        return (0, makeOpts)
+    m = re.search(r'(?:^|\s)(?:-j\s*|--jobs[=\s])([0-9]+)(?=\s|$)', makeOpts)
+    if m is None:
+        # job count is not specified, it is unlimited or 1, run the addons one by one
+        return (1, makeOpts)
+    jobs = int(m.group(1))
+    parallelCount = max(1, min(count, jobs))
+    jobsEach = max(1, jobs // parallelCount)
+    return (parallelCount, makeOpts[:m.start(1)] + str(jobsEach) + makeOpts[m.end(1):])
+
 
 def _getKernelVerStr(kernelDir):
     version = None
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2005-2014 Fpemud <fpemud@sina.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import os
+import json
+import hashlib
+import threading
+from ._util import Util
+from ._exception import RepoError
+from ._exception import FetchError
+
+
+class Manifest:
+
+    """The "Manifest" file in atom directory, in the style of Portage.
+       Line format: "DIST <filename> <size> BLAKE2B <hex-digest> SHA512 <hex-digest>"."""
+
+    HASH_FUNCS = {
+        "BLAKE2B": hashlib.blake2b,
+        "SHA512": hashlib.sha512,
+    }
+
+    def __init__(self, filepath):
+        self._distDict = dict()
+
+        with open(filepath, "r") as f:
+            for line in f:
+                partList = line.split()
+                if len(partList) == 0:
+                    continue
+                if partList[0] != "DIST":
+                    # other entry types are ignored
+                    continue
+                if len(partList) < 3 or len(partList) % 2 != 1 or not partList[2].isdigit():
+                    raise RepoError("invalid line \"%s\" in \"%s\"" % (line.rstrip(), filepath))
+                hashDict = dict()
+                for i in range(3, len(partList), 2):
+                    if partList[i] in self.HASH_FUNCS:
+                        hashDict[partList[i]] = partList[i + 1].lower()
+                if len(hashDict) == 0:
+                    raise RepoError("no supported hash in line \"%s\" in \"%s\"" % (line.rstrip(), filepath))
+                self._distDict[partList[1]] = ManifestDistEntry(partList[1], int(partList[2]), hashDict)
+
+    def get_dist_entry(self, filename):
+        # returns None if not found
+        return self._distDict.get(filename)
+
+
+class ManifestDistEntry:
+
+    def __init__(self, filename, size, hashDict):
+        self._filename = filename
+        self._size = size
+        self._hashDict = hashDict
+
+    @property
+    def filename(self):
+        return self._filename
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def digest_id(self):
+        # identifies the expected content
+        return "%d %s" % (self._size, " ".join(["%s %s" % (k, v) for k, v in sorted(self._hashDict.items())]))
+
+    def new_checker(self):
+        return _DistChecker(self)
+
+    def verify_file(self, filepath):
+        checker = self.new_checker()
+        with open(filepath, "rb") as f:
+            while True:
+                buf = f.read(1024 * 1024)
+                if len(buf) == 0:
+                    break
+                checker.update(buf)
+        checker.check(filepath)
+
+
+class DistfileStampCache:
+
+    """Records distfiles which have been verified against manifest, so that they are not hashed again.
+       A stamp is valid only when size and mtime of the distfile and the manifest entry are not changed."""
+
+    def __init__(self, filepath):
+        self._filepath = filepath
+        self._lock = threading.Lock()
+        self._bChanged = False
+        try:
+            with open(self._filepath, "r") as f:
+                self._stampDict = json.load(f)                   # {distfile-path: [size, mtime_ns, digest-id]}
+        except (OSError, ValueError):
+            self._stampDict = dict()
+
+    def verify(self, filepath, dist_entry):
+        # raises FetchError if verification fails
+        st = os.stat(filepath)
+        with self._lock:
+            if self._stampDict.get(filepath) == [st.st_size, st.st_mtime_ns, dist_entry.digest_id]:
+                return
+        dist_entry.verify_file(filepath)
+        self.add_stamp(filepath, dist_entry)
+
+    def add_stamp(self, filepath, dist_entry):
+        st = os.stat(filepath)
+        with self._lock:
+            self._stampDict[filepath] = [st.st_size, st.st_mtime_ns, dist_entry.digest_id]
+            self._bChanged = True
+
+    def save(self):
+        with self._lock:
+            if not self._bChanged:
+                return
+            if Util.writeJsonFile(self._filepath, self._stampDict, bIgnoreError=True):
+                self._bChanged = False
+
+
+class _DistChecker:
+
+    def __init__(self, distEntry):
+        self._distEntry = distEntry
+        self._size = 0
+        self._hashObjDict = {k: Manifest.HASH_FUNCS[k]() for k in distEntry._hashDict}
+
+    def update(self, buf):
+        self._size += len(buf)
+        for h in self._hashObjDict.values():
+            h.update(buf)
+
+    def check(self, filepath):
+        if self._size != self._distEntry.size:
+            raise FetchError("size of \"%s\" is %d, but %d is expected" % (filepath, self._size, self._distEntry.size))
+        for k, h in self._hashObjDict.items():
+            if h.hexdigest() != self._distEntry._hashDict[k]:
+                raise FetchError("%s digest of \"%s\" does not match" % (k, filepath))
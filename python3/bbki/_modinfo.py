@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2005-2014 Fpemud <fpemud@sina.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import os
+import glob
+import gzip
+import lzma
+import mmap
+import struct
+import subprocess
+
+
+class ModInfo:
+
+    """Reads the .modinfo section of a kernel module file directly, /bin/modinfo is not needed"""
+
+    SUFFIX_LIST = [".ko", ".ko.xz", ".ko.zst", ".ko.gz"]
+
+    @staticmethod
+    def glob_kmod_files(modules_dir):
+        ret = []
+        for suffix in ModInfo.SUFFIX_LIST:
+            ret += glob.glob(os.path.join(modules_dir, "**", "*" + suffix), recursive=True)
+        return sorted(ret)
+
+    def __init__(self, filepath):
+        self._fieldDict = dict()
+
+        if filepath.endswith(".ko"):
+            with open(filepath, "rb") as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    raise ValueError("\"%s\" is empty" % (filepath))
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                    self._parse(buf, filepath)
+        elif filepath.endswith(".ko.xz"):
+            with open(filepath, "rb") as f:
+                self._parse(lzma.decompress(f.read()), filepath)
+        elif filepath.endswith(".ko.gz"):
+            with open(filepath, "rb") as f:
+                self._parse(gzip.decompress(f.read()), filepath)
+        elif filepath.endswith(".ko.zst"):
+            self._parse(_zstdDecompressFile(filepath), filepath)
+        else:
+            raise ValueError("\"%s\" is not a kernel module file" % (filepath))
+
+    @property
+    def firmware(self):
+        return self.get("firmware")
+
+    @property
+    def depends(self):
+        # "depends" field is a comma seperated list, there's only one such field
+        ret = []
+        for value in self.get("depends"):
+            ret += [x for x in value.split(",") if x != ""]
+        return ret
+
+    @property
+    def alias(self):
+        return self.get("alias")
+
+    def get(self, key):
+        return self._fieldDict.get(key, [])
+
+    def _parse(self, buf, filepath):
+        if buf[:4] != b"\x7fELF":
+            raise ValueError("\"%s\" is not an ELF file" % (filepath))
+
+        if buf[5] == 1:
+            endian = "<"
+        elif buf[5] == 2:
+            endian = ">"
+        else:
+            raise ValueError("\"%s\" has invalid ELF data encoding" % (filepath))
+
+        if buf[4] == 1:
+            # ELF32: e_shoff, e_shentsize, e_shnum, e_shstrndx; sh_name, sh_offset, sh_size
+            shoff, = struct.unpack_from(endian + "I", buf, 0x20)
+            shentsize, shnum, shstrndx = struct.unpack_from(endian + "HHH", buf, 0x2E)
+            shFmt, shNameOff, shOffsetOff = "I", 0, 16
+        elif buf[4] == 2:
+            # ELF64: same as above
+            shoff, = struct.unpack_from(endian + "Q", buf, 0x28)
+            shentsize, shnum, shstrndx = struct.unpack_from(endian + "HHH", buf, 0x3A)
+            shFmt, shNameOff, shOffsetOff = "Q", 0, 24
+        else:
+            raise ValueError("\"%s\" has invalid ELF class" % (filepath))
+
+        def __section(i):
+            pos = shoff + i * shentsize
+            name, = struct.unpack_from(endian + "I", buf, pos + shNameOff)
+            offset, size = struct.unpack_from(endian + shFmt * 2, buf, pos + shOffsetOff)
+            return (name, offset, size)
+
+        dummy, strtabOffset, strtabSize = __section(shstrndx)
+        strtab = buf[strtabOffset:strtabOffset + strtabSize]
+
+        for i in range(0, shnum):
+            name, offset, size = __section(i)
+            if strtab[name:strtab.index(b"\0", name)] == b".modinfo":
+                for item in buf[offset:offset + size].split(b"\0"):
+                    if b"=" in item:
+                        k, v = item.decode("utf-8", errors="replace").split("=", 1)
+                        self._fieldDict.setdefault(k, []).append(v)
+                break
+
+
+def _zstdDecompressFile(filepath):
+    try:
+        import zstandard
+        with open(filepath, "rb") as f:
+            return zstandard.ZstdDecompressor().decompressobj().decompress(f.read())
+    except ImportError:
+        return subprocess.run(["zstd", "-dcq", filepath], stdout=subprocess.PIPE, check=True).stdout
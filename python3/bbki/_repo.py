@@ -23,6 +23,7 @@
 
 import os
 import re
+import json
 import glob
 import robust_layer.simple_git
 from ._util import Util
@@ -36,8 +37,14 @@ class Repo:
     ATOM_TYPE_KERNEL_ADDON = 2
     ATOM_TYPE_INITRAMFS = 3
 
-    def __init__(self, path):
+    # increase it when index file format or atom order changes
+    INDEX_FORMAT = 2
+
+    def __init__(self, path, index_file=None):
+        # index_file: where the atom index is saved, None means the index is only kept in memory
         self._path = path
+        self._indexFile = index_file
+        self._tIndex = None
 
     @property
     def name(self):
@@ -58,6 +65,7 @@ class Repo:
     def sync(self):
         # Business exception should not be raise, but be printed as error message
         robust_layer.simple_git.pull(self._path, reclone_on_failure=True, url="https://gitee.com/your-own-os/bbki-repo")
+        self._tIndex = None
 
     def check(self, autofix=False):
         if not self.exists():
@@ -73,30 +81,65 @@ class Repo:
     #     return ret
 
     def query_atom_type_name(self):
-        ret = []
-        for kernelType in [KernelType.LINUX]:
-            kernelDir = os.path.join(self._path, kernelType)
-            if os.path.exists(kernelDir):
-                for fn in os.listdir(kernelDir):
-                    ret.append((kernelType, self.ATOM_TYPE_KERNEL, fn))
-            kernelAddonDir = os.path.join(self._path, kernelType + "-addon")
-            if os.path.exists(kernelAddonDir):
-                for fn in os.listdir(kernelAddonDir):
-                    ret.append((kernelType, self.ATOM_TYPE_KERNEL_ADDON, fn))
-            initramfsDir = os.path.join(self._path, kernelType + "-initramfs")
-            if os.path.exists(initramfsDir):
-                for fn in os.listdir(initramfsDir):
-                    ret.append((kernelType, self.ATOM_TYPE_INITRAMFS, fn))
-        return ret
+        self._fillt()                                       # fill cache
+        return list(self._tIndex.keys())                    # return value according to cache
 
     def get_atoms_by_type_name(self, kernel_type, atom_type, atom_name):
         assert atom_type in [self.ATOM_TYPE_KERNEL, self.ATOM_TYPE_KERNEL_ADDON, self.ATOM_TYPE_INITRAMFS]
 
-        ret = []
-        dirpath = os.path.join(self._path, _format_catdir(kernel_type, atom_type), atom_name)
-        for fullfn in glob.glob(os.path.join(dirpath, "*.bbki")):
-            ret.append(_new_atom_from_bbki_filepath(self, fullfn))
-        return ret
+        self._fillt()                                                           # fill cache
+        return list(self._tIndex.get((kernel_type, atom_type, atom_name), []))  # return value according to cache
+
+    def _fillt(self):
+        # index format: {(kernel_type, atom_type, atom_name): [RepoAtom, ...]}, atom list is sorted by version, from old to new
+        # index file is valid only when git HEAD and mtimes of all the directories are not changed
+        if self._tIndex is not None:
+            return
+
+        gitHead = _get_git_head(self._path)
+
+        if self._indexFile is not None:
+            try:
+                with open(self._indexFile, "r") as f:
+                    data = json.load(f)
+                if data["format"] == self.INDEX_FORMAT and data["path"] == self._path and data["git_head"] == gitHead and _get_dir_mtimes(self._path, data["dir_mtimes"].keys()) == data["dir_mtimes"]:
+                    self._tIndex = dict()
+                    for kernelType, atomType, atomName, verRevList in data["atoms"]:
+                        self._tIndex[(kernelType, atomType, atomName)] = [RepoAtom(self, kernelType, atomType, atomName, ver, rev) for ver, rev in verRevList]
+                    return
+            except (OSError, ValueError, KeyError):
+                pass
+
+        # scan the repository
+        self._tIndex = dict()
+        dirList = []
+        if os.path.exists(self._path):
+            dirList.append(self._path)
+            for kernelType in [KernelType.LINUX]:
+                for atomType in [self.ATOM_TYPE_KERNEL, self.ATOM_TYPE_KERNEL_ADDON, self.ATOM_TYPE_INITRAMFS]:
+                    catDir = os.path.join(self._path, _format_catdir(kernelType, atomType))
+                    if not os.path.exists(catDir):
+                        continue
+                    dirList.append(catDir)
+                    for atomName in sorted(os.listdir(catDir)):
+                        atomDir = os.path.join(catDir, atomName)
+                        dirList.append(atomDir)
+                        atomList = []
+                        for fullfn in glob.glob(os.path.join(atomDir, "*.bbki")):
+                            atomList.append(_new_atom_from_bbki_filepath(self, fullfn))
+                        atomList.sort(key=lambda x: x.version_key)
+                        self._tIndex[(kernelType, atomType, atomName)] = atomList
+
+        # save index file
+        if self._indexFile is not None and len(dirList) > 0:
+            data = {
+                "format": self.INDEX_FORMAT,
+                "path": self._path,
+                "git_head": gitHead,
+                "dir_mtimes": _get_dir_mtimes(self._path, [os.path.relpath(x, self._path) for x in dirList]),
+                "atoms": [[k[0], k[1], k[2], [[x.ver, x.rev] for x in v]] for k, v in self._tIndex.items()],
+            }
+            Util.writeJsonFile(self._indexFile, data, bIgnoreError=True)
 
 
 class RepoAtom:
@@ -108,6 +151,7 @@ class RepoAtom:
         self._name = atom_name
         self._ver = ver
         self._rev = rev
+        self._versionKey = None
 
     @property
     def kernel_type(self):
@@ -138,7 +182,14 @@ class RepoAtom:
         if self.rev == 0:
             return self.ver
         else:
-            return self.ver + "-r" + self.rev
+            return self.ver + "-r" + str(self.rev)
+
+    @property
+    def version_key(self):
+        # comparable object, use it to sort atoms by version
+        if self._versionKey is None:
+            self._versionKey = Util.verstrToKey(self.verstr)
+        return self._versionKey
 
     @property
     def bbki_dir(self):
@@ -149,6 +200,39 @@ class RepoAtom:
         return os.path.join(self.bbki_dir, self.verstr + ".bbki")
 
 
+def _get_git_head(repoDir):
+    # read commit id directly, calling git is much slower
+    gitDir = os.path.join(repoDir, ".git")
+    try:
+        with open(os.path.join(gitDir, "HEAD"), "r") as f:
+            head = f.read().strip()
+        if not head.startswith("ref: "):
+            return head
+        ref = head[len("ref: "):]
+        refFile = os.path.join(gitDir, ref)
+        if os.path.exists(refFile):
+            with open(refFile, "r") as f:
+                return f.read().strip()
+        with open(os.path.join(gitDir, "packed-refs"), "r") as f:
+            for line in f:
+                m = re.fullmatch(r'([0-9a-f]+) (\S+)', line.strip())
+                if m is not None and m.group(2) == ref:
+                    return m.group(1)
+    except OSError:
+        pass
+    return None
+
+
+def _get_dir_mtimes(repoDir, relDirList):
+    ret = dict()
+    for relDir in relDirList:
+        try:
+            ret[relDir] = os.stat(os.path.join(repoDir, relDir)).st_mtime_ns
+        except FileNotFoundError:
+            ret[relDir] = None
+    return ret
+
+
 def _format_catdir(kernel_type, atom_type):
     if atom_type == Repo.ATOM_TYPE_KERNEL:
         return kernel_type
@@ -175,7 +259,7 @@ def _parse_catdir(catdir):
 
 
 def _parse_bbki_filename(filename):
-    m = re.fullmatch(r'(.*)(-r([0-9]+))?\.bbki', filename)
+    m = re.fullmatch(r'(.*?)(-r([0-9]+))?\.bbki', filename)
     if m.group(2) is None:
         return (m.group(1), 0)
     else:
@@ -191,9 +275,4 @@ def _new_atom_from_bbki_filepath(repo, bbki_file):
     kernelType, atomType = _parse_catdir(catdir)
     ver, rev = _parse_bbki_filename(fn)
 
-    ret = RepoAtom(repo, kernelType, atomType, atomName, ver, rev)
-    ret._atomType = atomType
-    ret._name = atomName
-    ret._ver = ver
-    ret._rev = rev
-    return ret
+    return RepoAtom(repo, kernelType, atomType, atomName, ver, rev)
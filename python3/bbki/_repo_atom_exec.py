@@ -23,19 +23,22 @@
 
 import os
 import re
-import shutil
+import json
+import hashlib
 import inspect
 import pathlib
-import tarfile
-import zipfile
 import platform
 import urllib.parse
-import robust_layer.simple_git
 import robust_layer.simple_fops
 from ._util import Util
-from ._util import TempChdir
+from ._util import BashCoprocess
 from ._repo import Repo
+from ._fetch import Fetcher
+from ._manifest import Manifest
+from ._git_store import GitStore
+from ._unpack import SourceUnpacker
 from ._exception import RepoError
+from ._exception import FetchError
 from ._initramfs import InitramfsInstaller
 
 
@@ -45,12 +48,16 @@ class BbkiAtomExecutor:
     def get_valid_bbki_functions():
         return [m[len("exec_"):] for m in dir(BbkiAtomExecutor) if m.startswith("exec_")]
 
-    def __init__(self, bbki, atom):
+    def __init__(self, bbki, atom, use_coprocess=False):
+        # use_coprocess: keep one bash process per atom instead of starting one for each call, dispose() should be called after use
         self._bbki = bbki
         self._atom = atom
         self._tVarDict = None
         self._tFuncList = None
+        self._tManifest = None
         self._tmpRootDir, self._trTmpDir, self._trWorkDir = _tmpdirs(self._bbki, self._atom)
+        self._bUseCoprocess = use_coprocess
+        self._coproc = None
 
     def get_variables(self):
         self._fillt()                           # fill cache
@@ -74,7 +81,7 @@ class BbkiAtomExecutor:
 
     def get_distfiles(self):
         if self.has_function("fetch"):
-            return [_custom_src_dir(self)]
+            return [_custom_src_dir(self._atom)]
         else:
             return [localFn for downloadType, url, localFn in _distfiles_get(self)]
 
@@ -87,16 +94,16 @@ class BbkiAtomExecutor:
     def get_tmp_dir(self):
         return self._trTmpDir
 
+    def get_kbuild_dir(self):
+        self._restrict_atom_type(Repo.ATOM_TYPE_KERNEL)
+        return _kbuild_dir(self._bbki, self._atom)
+
     def run_for_variable_values(self, varList):
-        out = None
         robust_layer.simple_fops.mkdir(self._bbki._cfg.tmp_dir)
-        with TempChdir(self._bbki._cfg.tmp_dir):
-            cmd = ""
-            cmd += self._vars_common()
-            cmd += "source %s\n" % (self._atom.bbki_file)
-            for var in varList:
-                cmd += "echo %s=${%s}\n" % (var, var)
-            out = Util.cmdCall("/bin/bash", "-c", cmd)
+        cmd = ""
+        for var in varList:
+            cmd += "echo %s=${%s}\n" % (var, var)
+        out = self._runBash(self._bbki._cfg.tmp_dir, "", cmd)
 
         ret = dict()
         for line in out.split("\n"):
@@ -107,93 +114,91 @@ class BbkiAtomExecutor:
 
     def create_tmpdirs(self):
         if os.path.exists(self._tmpRootDir):
+            SourceUnpacker.umount_all(self._tmpRootDir)
             robust_layer.simple_fops.rm(self._tmpRootDir)
         os.makedirs(self._trTmpDir)
         os.makedirs(self._trWorkDir)
 
     def remove_tmpdirs(self):
+        SourceUnpacker.umount_all(self._tmpRootDir)
         robust_layer.simple_fops.rm(self._tmpRootDir)
 
-    def exec_fetch(self):
-        if self._item_has_me():
+    def dispose(self):
+        if self._coproc is not None:
+            self._coproc.close()
+            self._coproc = None
+
+    def add_fetch_tasks(self, fetcher):
+        if self.has_function("fetch"):
             # custom action
+            if self._get_ro_distfile_path(_custom_src_dir(self._atom)) is not None:
+                return
             targetDir = os.path.join(self._bbki._cfg.cache_distfiles_dir, _custom_src_dir(self._atom))
-            os.makedirs(targetDir, exist_ok=True)
-            with TempChdir(targetDir):
-                cmd = ""
-                cmd += self._vars_common()
-                cmd += "source %s\n" % (self._atom.bbki_file)
-                cmd += "fetch\n"
-                Util.cmdCall("/bin/bash", "-c", cmd)
+            fetcher.add_func(targetDir, self._custom_fetch, targetDir)
         else:
             # default action
             for downloadType, url, localFn in _distfiles_get(self):
-                localFullFn = os.path.join(self._bbki._cfg.cache_distfiles_dir, localFn)
-                os.makedirs(os.path.dirname(localFullFn), exist_ok=True)
                 if downloadType == "git":
-                    robust_layer.simple_git.pull(localFullFn, reclone_on_failure=True, url=url)
+                    distEntry = None
+                else:
+                    distEntry = self._get_dist_entry(localFn)
+                if self._get_ro_distfile_path(localFn, distEntry) is not None:
+                    # use the one in read-only directory, git repository in read-only directory is not updated
+                    continue
+                if downloadType == "git":
+                    fetcher.add_git(url, self._get_git_store(), localFn)
                 elif downloadType == "wget":
-                    if not os.path.exists(localFullFn):
-                        os.makedirs(os.path.dirname(localFullFn), exist_ok=True)
-                        robust_layer.wget.exec("-O", localFullFn, url)
+                    fetcher.add_url(url, os.path.join(self._bbki._cfg.cache_distfiles_dir, localFn), distEntry)
                 else:
                     assert False
 
+    def exec_fetch(self):
+        fetcher = Fetcher(stamp_cache=self._bbki._distfileStampCache)
+        self.add_fetch_tasks(fetcher)
+        fetcher.run()
+
     def exec_src_unpack(self):
         if self._item_has_me():
             # custom action
-            with TempChdir(self._trWorkDir):
-                cmd = ""
-                cmd += self._vars_common()
-                cmd += self._vars_after_fetch()
-                cmd += "source %s\n" % (self._atom.bbki_file)
-                cmd += "src_unpack\n"
-                Util.cmdCall("/bin/bash", "-c", cmd)
+            self._runBash(self._trWorkDir, self._vars_after_fetch(), "src_unpack\n")
         else:
             # default action
+            unpacker = SourceUnpacker(self._bbki._cfg.cache_srctree_dir, self._bbki._cfg.cache_srctree_max_size, os.path.join(self._tmpRootDir, "overlay"))
             for downloadType, url, localFn in _distfiles_get(self):
-                localFullFn = os.path.join(self._bbki._cfg.cache_distfiles_dir, localFn)
-                if os.path.isdir(localFullFn):
-                    Util.shellCall("cp -r %s/* %s" % (localFullFn, self._trWorkDir))
-                elif tarfile.is_tarfile(localFullFn) or zipfile.is_zipfile(localFullFn):
-                    shutil.unpack_archive(localFullFn, self._trWorkDir)
-                else:
-                    Util.shellCall("cp %s %s" % (localFullFn, self._trWorkDir))
+                if downloadType == "git" and self._get_ro_distfile_path(localFn) is None:
+                    self._get_git_store().export(localFn, self._trWorkDir)
+                    continue
+                distEntry = self._get_dist_entry(localFn) if downloadType == "wget" else None
+                localFullFn = self._get_distfile_path(localFn, distEntry)
+                if distEntry is not None:
+                    self._bbki._distfileStampCache.verify(localFullFn, distEntry)
+                    self._bbki._distfileStampCache.save()
+                unpacker.unpack(localFullFn, self._trWorkDir, distEntry)
 
     def exec_src_prepare(self):
         if not self._item_has_me():
             return
 
-        with TempChdir(self._trWorkDir):
-            cmd = ""
-            cmd += self._vars_common()
-            cmd += self._vars_after_fetch()
-            cmd += "source %s\n" % (self._atom.bbki_file)
-            cmd += "src_prepare\n"
-            Util.cmdCall("/bin/bash", "-c", cmd)
+        self._runBash(self._trWorkDir, self._vars_after_fetch(), "src_prepare\n")
 
-    def exec_kernel_install(self, kernelConfigFile, kernelConfigRulesFile, boot_entry):
+    def exec_kernel_install(self, kernelConfigFile, kernelConfigRulesFile, boot_entry, makeopts=None):
         self._restrict_atom_type(Repo.ATOM_TYPE_KERNEL)
 
         if not self._item_has_me():
             return
 
-        with TempChdir(self._trWorkDir):
-            cmd = ""
-            cmd += self._vars_common()
-            cmd += self._vars_after_fetch()
-            cmd += "export MAKEOPTS='%s'\n" % (self._bbki._cfg.get_build_variable("MAKEOPTS"))
-            cmd += 'export PATH="%s:$PATH"\n' % (_get_script_helpers_dir())
-            cmd += "export KVER='%s'\n" % (boot_entry.verstr)
-            cmd += "export KERNEL_CONFIG_FILE='%s'\n" % (kernelConfigFile)
-            cmd += 'export PATH="%s:$PATH"\n' % (_get_script_helpers_dir())
-            cmd += "\n"
-            cmd += "export _KENREL_CONFIG_RULES_FILE='%s'\n" % (kernelConfigRulesFile)      # FIXME
-            cmd += "\n"
-            cmd += "source %s\n" % (self._atom.bbki_file)
-            cmd += "\n"
-            cmd += "kernel_install\n"
-            Util.cmdCall("/bin/bash", "-c", cmd)
+        cmd = ""
+        cmd += self._vars_after_fetch()
+        cmd += "export MAKEOPTS='%s'\n" % (makeopts if makeopts is not None else self._bbki._getMakeOpts())
+        cmd += 'export PATH="%s:$PATH"\n' % (_get_script_helpers_dir())
+        cmd += "export KVER='%s'\n" % (boot_entry.verstr)
+        cmd += "export KERNEL_CONFIG_FILE='%s'\n" % (kernelConfigFile)
+        cmd += 'export PATH="%s:$PATH"\n' % (_get_script_helpers_dir())
+        cmd += _vars_kbuild(self._bbki, self._atom)
+        cmd += _vars_compiler_cache(self._bbki)
+        cmd += "\n"
+        cmd += "export _KENREL_CONFIG_RULES_FILE='%s'\n" % (kernelConfigRulesFile)      # FIXME
+        self._runBash(self._trWorkDir, cmd, "kernel_install\n")
 
     def exec_kernel_cleanup(self, boot_entry):
         self._restrict_atom_type(Repo.ATOM_TYPE_KERNEL)
@@ -201,18 +206,13 @@ class BbkiAtomExecutor:
         if not self._item_has_me():
             return
 
-        with TempChdir(self._trWorkDir):
-            cmd = ""
-            cmd += self._vars_common()
-            cmd += self._vars_after_fetch()
-            cmd += 'export PATH="%s:$PATH"\n' % (_get_script_helpers_dir())
-            cmd += "export KVER='%s'\n" % (boot_entry.verstr)
-            cmd += "export KERNEL_MODULES_DIR='%s'\n" % (self._bbki._fsLayout.get_kernel_modules_dir(boot_entry.verstr))
-            cmd += "\n"
-            cmd += "source %s\n" % (self._atom.bbki_file)
-            cmd += "\n"
-            cmd += "kernel_cleanup\n"
-            Util.cmdCall("/bin/bash", "-c", cmd)
+        cmd = ""
+        cmd += self._vars_after_fetch()
+        cmd += 'export PATH="%s:$PATH"\n' % (_get_script_helpers_dir())
+        cmd += "export KVER='%s'\n" % (boot_entry.verstr)
+        cmd += "export KERNEL_MODULES_DIR='%s'\n" % (self._bbki._fsLayout.get_kernel_modules_dir(boot_entry.verstr))
+        cmd += _vars_kbuild(self._bbki, self._atom)
+        self._runBash(self._trWorkDir, cmd, "kernel_cleanup\n")
 
     def exec_kernel_addon_patch_kernel(self, kernel_atom, boot_entry):
         self._restrict_atom_type(Repo.ATOM_TYPE_KERNEL_ADDON)
@@ -221,17 +221,11 @@ class BbkiAtomExecutor:
             return
 
         dummy, dummy, kernelDir = _tmpdirs(self._bbki, kernel_atom)
-        with TempChdir(kernelDir):
-            cmd = ""
-            cmd += self._vars_common()
-            cmd += self._vars_after_fetch()
-            cmd += "export KVER='%s'\n" % (boot_entry.verstr)
-            cmd += "export KERNEL_DIR='%s'\n" % (kernelDir)
-            cmd += "\n"
-            cmd += "source %s\n" % (self._atom.bbki_file)
-            cmd += "\n"
-            cmd += "kernel_addon_patch_kernel\n"
-            Util.cmdCall("/bin/bash", "-c", cmd)
+        cmd = ""
+        cmd += self._vars_after_fetch()
+        cmd += "export KVER='%s'\n" % (boot_entry.verstr)
+        cmd += "export KERNEL_DIR='%s'\n" % (kernelDir)
+        self._runBash(kernelDir, cmd, "kernel_addon_patch_kernel\n")
 
     def exec_kernel_addon_contribute_config_rules(self, kernel_atom, boot_entry):
         self._restrict_atom_type(Repo.ATOM_TYPE_KERNEL_ADDON)
@@ -240,40 +234,30 @@ class BbkiAtomExecutor:
             return ""
 
         dummy, dummy, kernelDir = _tmpdirs(self._bbki, kernel_atom)
-        with TempChdir(self._trWorkDir):
-            cmd = ""
-            cmd += self._vars_common()
-            cmd += self._vars_after_fetch()
-            cmd += "export KVER='%s'\n" % (boot_entry.verstr)
-            cmd += "export KERNEL_DIR='%s'\n" % (kernelDir)
-            cmd += "\n"
-            cmd += "source %s\n" % (self._atom.bbki_file)
-            cmd += "\n"
-            cmd += "kernel_addon_contribute_config_rules\n"
-            return Util.cmdCall("/bin/bash", "-c", cmd)
+        cmd = ""
+        cmd += self._vars_after_fetch()
+        cmd += "export KVER='%s'\n" % (boot_entry.verstr)
+        cmd += "export KERNEL_DIR='%s'\n" % (kernelDir)
+        return self._runBash(self._trWorkDir, cmd, "kernel_addon_contribute_config_rules\n")
+
+    def exec_kernel_addon_build(self, kernel_atom, boot_entry, makeopts=None):
+        # optional, it only builds in WORKDIR, so that it can be run concurrently with other addons
+        self._restrict_atom_type(Repo.ATOM_TYPE_KERNEL_ADDON)
+
+        if not self._item_has_me():
+            return
+
+        cmd = self._vars_kernel_addon(kernel_atom, boot_entry, makeopts)
+        self._runBash(self._trWorkDir, cmd, "kernel_addon_build\n")
 
-    def exec_kernel_addon_install(self, kernel_atom, boot_entry):
+    def exec_kernel_addon_install(self, kernel_atom, boot_entry, makeopts=None):
         self._restrict_atom_type(Repo.ATOM_TYPE_KERNEL_ADDON)
 
         if not self._item_has_me():
             return
 
-        dummy, dummy, kernelDir = _tmpdirs(self._bbki, kernel_atom)
-        with TempChdir(self._trWorkDir):
-            cmd = ""
-            cmd += self._vars_common()
-            cmd += self._vars_after_fetch()
-            cmd += "export KVER='%s'\n" % (boot_entry.verstr)
-            cmd += "export KERNEL_DIR='%s'\n" % (kernelDir)
-            cmd += "export KERNEL_MODULES_DIR='%s'\n" % (self._bbki._fsLayout.get_kernel_modules_dir(boot_entry.verstr))
-            cmd += "export FIRMWARE_DIR='%s'\n" % (self._bbki._fsLayout.get_firmware_dir())
-            cmd += "export MAKEOPTS='%s'\n" % (self._bbki._cfg.get_build_variable("MAKEOPTS"))
-            cmd += 'export PATH="%s:$PATH"\n' % (_get_script_helpers_dir())
-            cmd += "\n"
-            cmd += "source %s\n" % (self._atom.bbki_file)
-            cmd += "\n"
-            cmd += "kernel_addon_install\n"
-            Util.cmdCall("/bin/bash", "-c", cmd)
+        cmd = self._vars_kernel_addon(kernel_atom, boot_entry, makeopts)
+        self._runBash(self._trWorkDir, cmd, "kernel_addon_install\n")
 
     def exec_kernel_addon_cleanup(self):
         self._restrict_atom_type(Repo.ATOM_TYPE_KERNEL_ADDON)
@@ -288,17 +272,11 @@ class BbkiAtomExecutor:
             return ""
 
         dummy, dummy, kernelDir = _tmpdirs(self._bbki, kernel_atom)
-        with TempChdir(kernelDir):
-            cmd = ""
-            cmd += self._vars_common()
-            cmd += self._vars_after_fetch()
-            cmd += "export KVER='%s'\n" % (boot_entry.verstr)
-            cmd += "export KERNEL_DIR='%s'\n" % (kernelDir)
-            cmd += "\n"
-            cmd += "source %s\n" % (self._atom.bbki_file)
-            cmd += "\n"
-            cmd += "initramfs_contribute_config_rules\n"
-            return Util.cmdCall("/bin/bash", "-c", cmd)
+        cmd = ""
+        cmd += self._vars_after_fetch()
+        cmd += "export KVER='%s'\n" % (boot_entry.verstr)
+        cmd += "export KERNEL_DIR='%s'\n" % (kernelDir)
+        return self._runBash(kernelDir, cmd, "initramfs_contribute_config_rules\n")
 
     def exec_initramfs_install(self, boot_entry):
         self._restrict_atom_type(Repo.ATOM_TYPE_INITRAMFS)
@@ -306,18 +284,12 @@ class BbkiAtomExecutor:
         # if self._item_has_me():
         if False:
             # custom action
-            with TempChdir(self._trWorkDir):
-                cmd = ""
-                cmd += self._vars_common()
-                cmd += self._vars_after_fetch()
-                cmd += "export KERNEL_CONFIG_FILE='%s'\n" % (boot_entry.kernel_config_filepath)
-                cmd += "export KERNEL_MODULES_DIR='%s'\n" % (boot_entry.kernel_modules_dirpath)
-                cmd += "export FIRMWARE_DIR='%s'\n" % (boot_entry.firmware_dirpath)
-                cmd += "\n"
-                cmd += "source %s\n" % (self._atom.bbki_file)
-                cmd += "\n"
-                cmd += "initramfs_install\n"
-                return Util.cmdCall("/bin/bash", "-c", cmd)
+            cmd = ""
+            cmd += self._vars_after_fetch()
+            cmd += "export KERNEL_CONFIG_FILE='%s'\n" % (boot_entry.kernel_config_filepath)
+            cmd += "export KERNEL_MODULES_DIR='%s'\n" % (boot_entry.kernel_modules_dirpath)
+            cmd += "export FIRMWARE_DIR='%s'\n" % (boot_entry.firmware_dirpath)
+            return self._runBash(self._trWorkDir, cmd, "initramfs_install\n")
         else:
             # FIXME
             InitramfsInstaller(self._bbki).install(self._trWorkDir, boot_entry)
@@ -326,7 +298,14 @@ class BbkiAtomExecutor:
         if self._tVarDict is not None and self._tFuncList is not None:
             return
 
-        lineList = pathlib.Path(self._atom.bbki_file).read_text().split("\n")
+        # metadata cache is keyed by the .bbki file and the common variables, which affect variable values
+        metadataCache = _MetadataCache(self._bbki, self._atom.bbki_file, self._vars_common())
+        ret = metadataCache.load()
+        if ret is not None:
+            self._tVarDict, self._tFuncList = ret
+            return
+
+        lineList = metadataCache.content.split("\n")
         lineList = [x.rstrip() for x in lineList]
 
         self._tVarDict = dict()
@@ -347,6 +326,8 @@ class BbkiAtomExecutor:
         if "fetch" in self._tFuncList and "SRC_URI" in self._tVarDict:
             raise RepoError("fetch() and SRC_URI are mutally exclusive")
 
+        metadataCache.save(self._tVarDict, self._tFuncList)
+
     def _restrict_atom_type(self, *atomTypes):
         if self._atom.atom_type not in atomTypes:
             raise NotImplementedError()
@@ -356,6 +337,89 @@ class BbkiAtomExecutor:
         assert parent_func_name.startswith("exec_")
         return self.has_function(parent_func_name[len("exec_"):])
 
+    def _get_git_store(self):
+        return GitStore(os.path.join(self._bbki._cfg.cache_distfiles_dir, GitStore.DIR_NAME))
+
+    def _get_git_distfile_tree(self, localFn):
+        # git distfile has no checkout in git store, export its source tree into temporary directory for variable A
+        # the export is done only once in the life of the temporary directory
+        ret = os.path.join(self._tmpRootDir, "distdir", localFn)
+        if not os.path.exists(ret):
+            tmpDir = ret + ".tmp"
+            if os.path.exists(tmpDir):
+                robust_layer.simple_fops.rm(tmpDir)
+            os.makedirs(tmpDir)
+            self._get_git_store().export(localFn, tmpDir)
+            os.rename(tmpDir, ret)
+        return ret
+
+    def _get_distfile_path(self, localFn, distEntry=None):
+        # distfile in read-only directories is used in place, then comes the one in cache_distfiles_dir
+        ret = self._get_ro_distfile_path(localFn, distEntry)
+        if ret is not None:
+            return ret
+        return os.path.join(self._bbki._cfg.cache_distfiles_dir, localFn)
+
+    def _get_ro_distfile_path(self, localFn, distEntry=None):
+        # returns None if not found, corrupt distfile in read-only directories is ignored since it can't be fixed
+        for roDir in self._bbki._cfg.cache_distfiles_ro_dir_list:
+            fullfn = os.path.join(roDir, localFn)
+            if not os.path.exists(fullfn):
+                continue
+            if distEntry is not None:
+                try:
+                    self._bbki._distfileStampCache.verify(fullfn, distEntry)
+                except FetchError:
+                    continue
+            return fullfn
+        return None
+
+    def _get_dist_entry(self, localFn):
+        # returns None if the atom has no Manifest file
+        if self._tManifest is None:
+            manifestFile = os.path.join(self._atom.bbki_dir, "Manifest")
+            self._tManifest = Manifest(manifestFile) if os.path.exists(manifestFile) else False
+        if self._tManifest is False:
+            return None
+
+        ret = self._tManifest.get_dist_entry(os.path.basename(localFn))
+        if ret is None:
+            raise RepoError("no Manifest entry for distfile \"%s\" of %s" % (os.path.basename(localFn), self._atom.fullname))
+        return ret
+
+    def _custom_fetch(self, targetDir):
+        os.makedirs(targetDir, exist_ok=True)
+        self._runBash(targetDir, "", "fetch\n")
+
+    def _runBash(self, cwd, varCmd, callCmd):
+        # varCmd: exports specific to this call, callCmd: the command which uses the .bbki file
+        if self._bUseCoprocess:
+            if self._coproc is None:
+                initCmd = ""
+                initCmd += self._vars_common()
+                initCmd += "source %s\n" % (self._atom.bbki_file)
+                self._coproc = BashCoprocess(initCmd)
+            cmd = ""
+            if varCmd != "":
+                # top level code of the .bbki file must see the same variables as in non-coprocess mode,
+                # so the file is sourced again in the subshell after the exports specific to this call
+                cmd += varCmd
+                cmd += "\n"
+                cmd += "source %s\n" % (self._atom.bbki_file)
+                cmd += "\n"
+            cmd += callCmd
+            return self._coproc.call(cwd, cmd)
+        else:
+            cmd = ""
+            cmd += "cd '%s' || exit 1\n" % (cwd)
+            cmd += self._vars_common()
+            cmd += varCmd
+            cmd += "\n"
+            cmd += "source %s\n" % (self._atom.bbki_file)
+            cmd += "\n"
+            cmd += callCmd
+            return Util.cmdCall("/bin/bash", "-c", cmd)
+
     def _vars_common(self):
         buf = ""
         if True:
@@ -372,11 +436,85 @@ class BbkiAtomExecutor:
     def _vars_after_fetch(self):
         buf = ""
         if True:
-            fnlist = [localFn for downloadType, url, localFn in _distfiles_get(self)]
-            fnlist = [os.path.join(os.path.join(self._bbki._cfg.cache_distfiles_dir, x)) for x in fnlist]
+            fnlist = []
+            for downloadType, url, localFn in _distfiles_get(self):
+                if downloadType == "git" and self._get_ro_distfile_path(localFn) is None:
+                    fnlist.append(self._get_git_distfile_tree(localFn))
+                else:
+                    fnlist.append(self._get_distfile_path(localFn))
             buf += "export A='%s'\n" % ("' '".join(fnlist))
         return buf
 
+    def _vars_kernel_addon(self, kernel_atom, boot_entry, makeopts):
+        dummy, dummy, kernelDir = _tmpdirs(self._bbki, kernel_atom)
+        buf = ""
+        buf += self._vars_after_fetch()
+        buf += "export KVER='%s'\n" % (boot_entry.verstr)
+        buf += "export KERNEL_DIR='%s'\n" % (kernelDir)
+        buf += "export KERNEL_MODULES_DIR='%s'\n" % (self._bbki._fsLayout.get_kernel_modules_dir(boot_entry.verstr))
+        buf += "export FIRMWARE_DIR='%s'\n" % (self._bbki._fsLayout.get_firmware_dir())
+        buf += "export MAKEOPTS='%s'\n" % (makeopts if makeopts is not None else self._bbki._getMakeOpts())
+        buf += 'export PATH="%s:$PATH"\n' % (_get_script_helpers_dir())
+        buf += _vars_kbuild(self._bbki, kernel_atom)
+        buf += _vars_compiler_cache(self._bbki)
+        return buf
+
+
+class _MetadataCache:
+
+    """Persistent cache of variable values and function list of a .bbki file.
+       File content is hashed only when its mtime or size changes, so an up-to-date entry is checked by a single stat()."""
+
+    def __init__(self, bbki, bbkiFile, varsCommon):
+        self._bbkiFile = bbkiFile
+        self._envHash = hashlib.sha256(varsCommon.encode("utf-8")).hexdigest()
+        self._cacheFile = os.path.join(bbki._cfg.cache_metadata_dir, hashlib.sha256(bbkiFile.encode("utf-8")).hexdigest() + ".json")
+        self._st = os.stat(self._bbkiFile)
+        self._content = None
+
+    @property
+    def content(self):
+        if self._content is None:
+            self._content = pathlib.Path(self._bbkiFile).read_text()
+        return self._content
+
+    def load(self):
+        # returns (varDict, funcList) or None
+        try:
+            with open(self._cacheFile, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if data.get("path") != self._bbkiFile or data.get("env_hash") != self._envHash:
+            return None
+        if data.get("size") != self._st.st_size:
+            return None
+        if data.get("mtime_ns") != self._st.st_mtime_ns:
+            # file is touched but may be not modified
+            if data.get("content_hash") != self._contentHash():
+                return None
+            self._write(data["variables"], data["functions"])
+        return (data["variables"], data["functions"])
+
+    def save(self, varDict, funcList):
+        self._write(varDict, funcList)
+
+    def _contentHash(self):
+        return hashlib.sha256(self.content.encode("utf-8")).hexdigest()
+
+    def _write(self, varDict, funcList):
+        data = {
+            "path": self._bbkiFile,
+            "size": self._st.st_size,
+            "mtime_ns": self._st.st_mtime_ns,
+            "content_hash": self._contentHash(),
+            "env_hash": self._envHash,
+            "variables": varDict,
+            "functions": funcList,
+        }
+        Util.writeJsonFile(self._cacheFile, data, bIgnoreError=True)
+
 
 def _get_script_helpers_dir():
     return os.path.join(os.path.dirname(os.path.realpath(__file__)), "script-helpers")
@@ -415,6 +553,32 @@ def _distfiles_get(exec_atom):
     return ret
 
 
+def _kbuild_dir(bbki, kernel_atom):
+    # persistent build directory of kernel, returns None if incremental build is disabled
+    if not bbki._cfg.get_kernel_incremental_build():
+        return None
+    return os.path.join(bbki._cfg.cache_kbuild_dir, kernel_atom.fullname)
+
+
+def _vars_kbuild(bbki, kernel_atom):
+    # kbuild puts all the output files into KBUILD_OUTPUT, same as "make O=", so the kernel and its addons must locate build result by it
+    dirpath = _kbuild_dir(bbki, kernel_atom)
+    if dirpath is None:
+        return ""
+    return "export KBUILD_OUTPUT='%s'\n" % (dirpath)
+
+
+def _vars_compiler_cache(bbki):
+    # used by emake helper
+    if bbki._compilerCache is None:
+        return ""
+    os.makedirs(bbki._compilerCache.cache_dir, exist_ok=True)
+    buf = ""
+    for k, v in bbki._compilerCache.get_env_vars().items():
+        buf += "export %s='%s'\n" % (k, v)
+    return buf
+
+
 def _tmpdirs(bbki, atom):
     tmpRootDir = os.path.join(bbki._cfg.tmp_dir, atom.fullname)
     # trBuildInfoDir = os.path.join(tmpRootDir, "build-info")     # FIXME
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2005-2014 Fpemud <fpemud@sina.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import os
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import tarfile
+import zipfile
+import tempfile
+import threading
+import robust_layer.simple_fops
+from ._util import Util
+
+
+class SourceUnpacker:
+
+    """Unpacks distfiles into work directory.
+       Archive is extracted only once into a cached source tree, which is then given to work directory by the first usable strategy:
+         1. reflink clone, needs filesystem support (btrfs, xfs), cached tree and work directory must be on the same filesystem
+         2. overlayfs with the cached tree as the read-only lower layer, needs root privilege and empty work directory
+         3. plain copy
+       Cached trees are keyed by the digest of the archive, least recently used ones are evicted when the cache exceeds its size limit."""
+
+    # ioctl number of FICLONE, see linux/fs.h
+    FICLONE = 0x40049409
+
+    INDEX_FILENAME = "index.json"
+
+    # {(src-st_dev, dst-st_dev): bool}
+    _reflinkDict = dict()
+    _reflinkDictLock = threading.Lock()
+
+    # serializes access to the cache index and the in-use trees
+    _indexLock = threading.Lock()
+
+    # {key: reference-count}, trees being used by this process are not evicted
+    _inUseDict = dict()
+
+    def __init__(self, cache_dir, cache_max_size, overlay_dir):
+        # cache_max_size: in bytes, 0 means not using the cache
+        # upper and work directories of overlayfs are created in overlay_dir
+        self._cacheDir = cache_dir
+        self._cacheMaxSize = cache_max_size
+        self._indexFile = os.path.join(cache_dir, self.INDEX_FILENAME)
+        self._overlayDir = overlay_dir
+
+    def unpack(self, filepath, target_dir, dist_entry=None):
+        # dist_entry: ManifestDistEntry, its digest is used as the cache key so that the archive needs not to be hashed
+        if os.path.isdir(filepath):
+            # directory distfile, eg. custom source directory
+            if self._isReflinkSupported(filepath, target_dir):
+                Util.shellCall("cp -r --reflink=always %s/* %s" % (filepath, target_dir))
+            else:
+                Util.shellCall("cp -r %s/* %s" % (filepath, target_dir))
+        elif tarfile.is_tarfile(filepath) or zipfile.is_zipfile(filepath):
+            if self._cacheMaxSize == 0:
+                shutil.unpack_archive(filepath, target_dir)
+                return
+            key = self._getKey(filepath, dist_entry)
+            treeDir = self._acquireCachedTree(filepath, key)
+            try:
+                if self._isReflinkSupported(treeDir, target_dir):
+                    Util.cmdCall("cp", "-a", "--reflink=always", treeDir + "/.", target_dir)
+                elif len(os.listdir(target_dir)) == 0 and self._mountOverlay(treeDir, target_dir):
+                    pass
+                else:
+                    Util.cmdCall("cp", "-a", treeDir + "/.", target_dir)
+            finally:
+                self._releaseCachedTree(key)
+        else:
+            Util.cmdCall("cp", "--reflink=auto", filepath, target_dir)
+
+    @staticmethod
+    def umount_all(dirpath):
+        # unmount all the overlayfs mounted by us under dirpath, deepest first
+        dirpath = os.path.realpath(dirpath)
+        for mp, opts in reversed(_getOverlayMounts()):
+            if mp.startswith(dirpath + "/"):
+                Util.cmdCall("umount", mp)
+
+    def _acquireCachedTree(self, filepath, key):
+        treeDir = os.path.join(self._cacheDir, key)
+        with self._indexLock:
+            self._inUseDict[key] = self._inUseDict.get(key, 0) + 1
+            bHit = os.path.isdir(treeDir)                   # tree is renamed into place only when completely extracted
+            if bHit and key in self._loadIndex()["trees"]:
+                self._updateIndex(key, None)
+                return treeDir
+
+        try:
+            if not bHit:
+                # extract into a temporary directory, so that no half-extracted tree is left
+                os.makedirs(self._cacheDir, exist_ok=True)
+                tmpDir = tempfile.mkdtemp(dir=self._cacheDir, prefix=".tmp-")
+                try:
+                    shutil.unpack_archive(filepath, tmpDir)
+                    os.chmod(tmpDir, 0o755)
+                    os.rename(tmpDir, treeDir)
+                except OSError:
+                    if not os.path.isdir(treeDir):
+                        raise
+                    # extracted by others simultaneously
+                finally:
+                    if os.path.exists(tmpDir):
+                        robust_layer.simple_fops.rm(tmpDir)
+
+            size = _getTreeSize(treeDir)
+            with self._indexLock:
+                self._updateIndex(key, size)
+        except BaseException:
+            self._releaseCachedTree(key)
+            raise
+        return treeDir
+
+    def _releaseCachedTree(self, key):
+        with self._indexLock:
+            self._inUseDict[key] -= 1
+            if self._inUseDict[key] == 0:
+                del self._inUseDict[key]
+
+    def _updateIndex(self, key, size):
+        # size: None means the tree is already recorded
+        index = self._loadIndex()
+        if size is not None:
+            index["trees"][key] = [size, time.time()]
+            self._evict(index)
+        else:
+            index["trees"][key][1] = time.time()
+        self._saveIndex(index)
+
+    def _getKey(self, filepath, distEntry):
+        if distEntry is not None:
+            return hashlib.sha256(distEntry.digest_id.encode("utf-8")).hexdigest()
+
+        # hash the archive only when its size or mtime changes
+        realPath = os.path.realpath(filepath)
+        st = os.stat(realPath)
+        with self._indexLock:
+            value = self._loadIndex()["files"].get(realPath)
+        if value is not None and value[:2] == [st.st_size, st.st_mtime_ns]:
+            return value[2]
+
+        h = hashlib.sha256()
+        with open(realPath, "rb") as f:
+            while True:
+                buf = f.read(1024 * 1024)
+                if len(buf) == 0:
+                    break
+                h.update(buf)
+        key = h.hexdigest()
+
+        with self._indexLock:
+            index = self._loadIndex()
+            index["files"][realPath] = [st.st_size, st.st_mtime_ns, key]
+            self._saveIndex(index)
+        return key
+
+    def _evict(self, index):
+        # trees used by this process and trees used as overlayfs lower layer are kept
+        mountedSet = set()
+        for mp, opts in _getOverlayMounts():
+            for opt in opts.split(","):
+                if opt.startswith("lowerdir="):
+                    mountedSet |= set(os.path.basename(x) for x in opt[len("lowerdir="):].split(":"))
+
+        # forget trees which are removed by others, and archives which are removed
+        for key in list(index["trees"]):
+            if not os.path.isdir(os.path.join(self._cacheDir, key)):
+                del index["trees"][key]
+        for realPath in list(index["files"]):
+            if not os.path.exists(realPath):
+                del index["files"][realPath]
+
+        total = sum([x[0] for x in index["trees"].values()])
+        for key in sorted(index["trees"], key=lambda x: index["trees"][x][1]):
+            if total <= self._cacheMaxSize:
+                break
+            if key in self._inUseDict or key in mountedSet:
+                continue
+            robust_layer.simple_fops.rm(os.path.join(self._cacheDir, key))
+            total -= index["trees"][key][0]
+            del index["trees"][key]
+
+    def _loadIndex(self):
+        # index format: {
+        #     "trees": {key: [size, last-used-time]},
+        #     "files": {archive-path: [size, mtime_ns, key]},
+        # }
+        try:
+            with open(self._indexFile, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {"trees": dict(), "files": dict()}
+
+    def _saveIndex(self, index):
+        Util.writeJsonFile(self._indexFile, index)
+
+    def _isReflinkSupported(self, srcDir, dstDir):
+        key = (os.stat(srcDir).st_dev, os.stat(dstDir).st_dev)
+        with self._reflinkDictLock:
+            if key in self._reflinkDict:
+                return self._reflinkDict[key]
+
+        # probe by cloning a temporary file
+        ret = False
+        if key[0] == key[1]:
+            try:
+                with tempfile.TemporaryFile(dir=dstDir) as src, tempfile.TemporaryFile(dir=dstDir) as dst:
+                    src.write(b"bbki")
+                    src.flush()
+                    fcntl.ioctl(dst.fileno(), self.FICLONE, src.fileno())
+                    ret = True
+            except OSError:
+                pass
+
+        with self._reflinkDictLock:
+            self._reflinkDict[key] = ret
+        return ret
+
+    def _mountOverlay(self, lowerDir, targetDir):
+        os.makedirs(self._overlayDir, exist_ok=True)
+        dirpath = tempfile.mkdtemp(dir=self._overlayDir)
+        upperDir = os.path.join(dirpath, "upper")
+        workDir = os.path.join(dirpath, "work")
+        os.mkdir(upperDir)
+        os.mkdir(workDir)
+        opts = "lowerdir=%s,upperdir=%s,workdir=%s" % (lowerDir, upperDir, workDir)
+        return Util.cmdCallTestSuccess("mount", "-t", "overlay", "overlay", "-o", opts, targetDir)
+
+
+def _getOverlayMounts():
+    # returns [(mount-point, mount-options)]
+    ret = []
+    with open("/proc/self/mounts") as f:
+        for line in f:
+            partList = line.split()
+            if partList[2] == "overlay":
+                partList = [x.replace("\\040", " ").replace("\\011", "\t").replace("\\012", "\n").replace("\\134", "\\") for x in partList]
+                ret.append((partList[1], partList[3]))
+    return ret
+
+
+def _getTreeSize(dirpath):
+    ret = 0
+    for root, dirs, files in os.walk(dirpath):
+        for fn in files:
+            ret += os.lstat(os.path.join(root, fn)).st_size
+    return ret
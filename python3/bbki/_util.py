@@ -24,7 +24,9 @@
 import os
 import re
 import glob
+import json
 import time
+import uuid
 import psutil
 import pathlib
 import subprocess
@@ -148,36 +150,85 @@ class Util:
             f.write("\n")
 
     @staticmethod
-    def compareVerstr(verstr1, verstr2):
-        """eg: 3.9.11-gentoo-r1 or 3.10.7-gentoo"""
+    def writeJsonFile(filepath, data, bIgnoreError=False):
+        # write to a temporary file and then rename, so that readers never see a half-written file
+        # bIgnoreError: for optional cache files, eg. cache directory is not writable for normal user
+        try:
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+            with open(filepath + ".tmp", "w") as f:
+                json.dump(data, f)
+            os.rename(filepath + ".tmp", filepath)
+            return True
+        except OSError:
+            if not bIgnoreError:
+                raise
+            return False
 
-        partList1 = verstr1.split("-")
-        partList2 = verstr2.split("-")
+    @staticmethod
+    def verstrToKey(verstr):
+        """eg: 3.9.11-gentoo-r1, 5.15-rc3 or 5.14, returns a tuple which can be compared directly"""
+
+        # revision
+        m = re.fullmatch(r'(.*?)(?:-r([0-9]+))?', verstr)
+        ver = m.group(1)
+        rev = int(m.group(2)) if m.group(2) is not None else 0
+
+        # version number, "5.14" equals to "5.14.0"
+        partList = ver.split("-", 1)
+        numList = []
+        for part in partList[0].split("."):
+            m = re.fullmatch(r'([0-9]*)(.*)', part)
+            numList.append((int(m.group(1)) if m.group(1) != "" else -1, m.group(2)))
+        while len(numList) > 0 and numList[-1] == (0, ""):
+            numList.pop()
+
+        # suffix, pre-release suffix is lower than none, other suffix is higher than none
+        suffix = partList[1] if len(partList) > 1 else ""
+        m = re.fullmatch(r'(alpha|beta|pre|rc)([0-9]*)', suffix)
+        if suffix == "":
+            suffixKey = (1, 0, 0)
+        elif m is not None:
+            suffixKey = (0, ["alpha", "beta", "pre", "rc"].index(m.group(1)), int(m.group(2)) if m.group(2) != "" else 0)
+        else:
+            suffixKey = (2, suffix, 0)
 
-        verList1 = partList1[0].split(".")
-        verList2 = partList2[0].split(".")
-        assert len(verList1) == 3 and len(verList2) == 3
+        return (tuple(numList), suffixKey, rev)
 
-        ver1 = int(verList1[0]) * 10000 + int(verList1[1]) * 100 + int(verList1[2])
-        ver2 = int(verList2[0]) * 10000 + int(verList2[1]) * 100 + int(verList2[2])
-        if ver1 > ver2:
-            return 1
-        elif ver1 < ver2:
-            return -1
+    @staticmethod
+    def compareVerstr(verstr1, verstr2):
+        """eg: 3.9.11-gentoo-r1 or 3.10.7-gentoo"""
 
-        if len(partList1) >= 2 and len(partList2) == 1:
+        key1 = Util.verstrToKey(verstr1)
+        key2 = Util.verstrToKey(verstr2)
+        if key1 > key2:
             return 1
-        elif len(partList1) == 1 and len(partList2) >= 2:
+        elif key1 < key2:
             return -1
+        else:
+            return 0
 
-        p1 = "-".join(partList1[1:])
-        p2 = "-".join(partList2[1:])
-        if p1 > p2:
-            return 1
-        elif p1 < p2:
-            return -1
+    @staticmethod
+    def getCpuCount():
+        # returns number of CPUs we can use, limited by CPU affinity and cgroup CPU quota
+        ret = len(os.sched_getaffinity(0))
+        for quota, period in _cgroupGetCpuQuotaList():
+            ret = min(ret, max(1, -(-quota // period)))        # round up
+        return ret
 
-        return 0
+    @staticmethod
+    def getAvailableMemory():
+        # returns available memory in bytes, limited by cgroup memory limit
+        ret = None
+        with open("/proc/meminfo") as f:
+            for line in f:
+                m = re.fullmatch(r'MemAvailable:\s+([0-9]+) kB', line.rstrip())
+                if m is not None:
+                    ret = int(m.group(1)) * 1024
+                    break
+        assert ret is not None
+        for limit, usage in _cgroupGetMemoryLimitList():
+            ret = min(ret, max(0, limit - usage))
+        return ret
 
     @staticmethod
     def cmdCall(cmd, *kargs):
@@ -423,6 +474,144 @@ class TempChdir:
         os.chdir(self.olddir)
 
 
+class BashCoprocess:
+
+    """A persistent bash process, commands are sent through stdin and the output of each command is framed by a marker line.
+       Each command runs in a subshell, so that it can't change the state of the persistent shell."""
+
+    def __init__(self, init_cmd=None):
+        self._marker = "__BASH_COPROCESS_%s__" % (uuid.uuid4().hex)
+        self._proc = None
+        self._proc = subprocess.Popen(["/bin/bash", "--norc", "--noprofile", "-s"],
+                                      stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                      universal_newlines=True)
+        if init_cmd is not None:
+            # init command is executed in the persistent shell itself
+            try:
+                self._exec(init_cmd)
+            except BaseException:
+                self.close()
+                raise
+
+    def call(self, cwd, cmd):
+        # same return value and exception as Util.cmdCall()
+        buf = ""
+        buf += "(\n"
+        buf += "cd '%s' || exit 1\n" % (cwd)
+        buf += cmd
+        buf += "\n) </dev/null\n"
+        return self._exec(buf)
+
+    def close(self):
+        if self._proc is not None:
+            try:
+                self._proc.stdin.close()
+            except BrokenPipeError:
+                pass
+            self._proc.wait()
+            self._proc.stdout.close()
+            self._proc = None
+
+    def __del__(self):
+        # fallback for the owner who does not call close()
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def _exec(self, cmd):
+        assert self._proc is not None
+
+        self._proc.stdin.write(cmd)
+        self._proc.stdin.write("\nprintf '\\n%s %%d\\n' $?\n" % (self._marker))
+        self._proc.stdin.flush()
+
+        lineList = []
+        while True:
+            line = self._proc.stdout.readline()
+            if line == "":
+                self._proc.wait()
+                raise subprocess.CalledProcessError(self._proc.returncode, "/bin/bash", "".join(lineList))
+            if line.startswith(self._marker + " "):
+                returncode = int(line[len(self._marker) + 1:])
+                break
+            lineList.append(line)
+        out = "".join(lineList)[:-1]            # remove the newline printed before the marker
+
+        if returncode > 128:
+            # same as Util.cmdCall()
+            time.sleep(1.0)
+        if returncode != 0:
+            print(out)
+            raise subprocess.CalledProcessError(returncode, "/bin/bash", out)
+        return out.rstrip()
+
+
+def _cgroupGetDirList(controller):
+    # returns cgroup directories of the current process, from leaf to root
+    ret = []
+    try:
+        with open("/proc/self/cgroup") as f:
+            lineList = f.read().split("\n")
+    except OSError:
+        return ret
+    for line in lineList:
+        partList = line.split(":", 2)
+        if len(partList) != 3:
+            continue
+        if partList[1] == "":
+            rootDir = "/sys/fs/cgroup"                                  # cgroup v2
+        elif controller in partList[1].split(","):
+            rootDir = os.path.join("/sys/fs/cgroup", partList[1])       # cgroup v1
+        else:
+            continue
+        dirpath = os.path.normpath(os.path.join(rootDir, partList[2].lstrip("/")))
+        while True:
+            ret.append(dirpath)
+            if dirpath == rootDir:
+                break
+            dirpath = os.path.dirname(dirpath)
+    return ret
+
+
+def _cgroupGetCpuQuotaList():
+    # returns [(quota, period)]
+    ret = []
+    for dirpath in _cgroupGetDirList("cpu"):
+        try:
+            if os.path.exists(os.path.join(dirpath, "cpu.max")):
+                quota, period = pathlib.Path(os.path.join(dirpath, "cpu.max")).read_text().split()
+            else:
+                quota = pathlib.Path(os.path.join(dirpath, "cpu.cfs_quota_us")).read_text().strip()
+                period = pathlib.Path(os.path.join(dirpath, "cpu.cfs_period_us")).read_text().strip()
+        except (OSError, ValueError):
+            continue
+        if quota != "max" and int(quota) > 0:
+            ret.append((int(quota), int(period)))
+    return ret
+
+
+def _cgroupGetMemoryLimitList():
+    # returns [(limit, usage)]
+    ret = []
+    for dirpath in _cgroupGetDirList("memory"):
+        try:
+            if os.path.exists(os.path.join(dirpath, "memory.max")):
+                limit = pathlib.Path(os.path.join(dirpath, "memory.max")).read_text().strip()
+                usage = pathlib.Path(os.path.join(dirpath, "memory.current")).read_text().strip()
+            else:
+                limit = pathlib.Path(os.path.join(dirpath, "memory.limit_in_bytes")).read_text().strip()
+                usage = pathlib.Path(os.path.join(dirpath, "memory.usage_in_bytes")).read_text().strip()
+        except OSError:
+            continue
+        if limit.isdigit() and usage.isdigit():
+            ret.append((int(limit), int(usage)))
+    return ret
+
+
 class PhysicalDiskMounts:
 
     """This class is a better psutil.disk_partitions()"""
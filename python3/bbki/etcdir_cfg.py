@@ -29,6 +29,8 @@ from ._po import KernelType
 from ._po import SystemInit
 from ._config import ConfigBase
 from ._exception import ConfigError
+from ._initramfs_compressor import InitramfsCompressor
+from ._compiler_cache import CompilerCache
 
 
 class Config(ConfigBase):
@@ -60,7 +62,11 @@ class Config(ConfigBase):
 
         self._cacheDir = self.DEFAULT_CACHE_DIR
         self._cacheDistfilesDir = os.path.join(self._cacheDir, "distfiles")
-        self._cacheDistfilesRoDirList = []
+        self._cacheInitramfsDir = os.path.join(self._cacheDir, "initramfs")
+        self._cacheMetadataDir = os.path.join(self._cacheDir, "metadata")
+        self._cacheSrctreeDir = os.path.join(self._cacheDir, "srctree")
+        self._cacheKbuildDir = os.path.join(self._cacheDir, "kbuild")
+        self._cacheCompilerDir = os.path.join(self._cacheDir, "compiler")
 
         self._tmpDir = self.DEFAULT_TMP_DIR
 
@@ -77,8 +83,8 @@ class Config(ConfigBase):
         self._filltOptions()
 
         # validate and fill cache
-        self._tMaskBufList = None
-        self._filltMaskBufList()
+        self._tMaskRuleDict = None
+        self._filltMaskRuleDict()
 
     @property
     def data_repo_dir(self):
@@ -90,7 +96,31 @@ class Config(ConfigBase):
 
     @property
     def cache_distfiles_ro_dir_list(self):
-        return self._cacheDistfilesRoDirList
+        return self._tOptions["distfiles"]["ro-dirs"]
+
+    @property
+    def cache_metadata_dir(self):
+        return self._cacheMetadataDir
+
+    @property
+    def cache_initramfs_dir(self):
+        return self._cacheInitramfsDir
+
+    @property
+    def cache_srctree_dir(self):
+        return self._cacheSrctreeDir
+
+    @property
+    def cache_kbuild_dir(self):
+        return self._cacheKbuildDir
+
+    @property
+    def cache_compiler_dir(self):
+        return self._cacheCompilerDir
+
+    @property
+    def cache_srctree_max_size(self):
+        return self._tOptions["srctree"]["cache-size"]
 
     @property
     def tmp_dir(self):
@@ -114,9 +144,17 @@ class Config(ConfigBase):
     def get_kernel_addon_names(self):
         return self._tKernelAddonNameList
 
+    def get_compiler_cache(self):
+        return self._tOptions["build"]["compiler-cache"]
+
     def get_initramfs_name(self):
         return "minitrd"            # FIXME
 
+    def get_initramfs_compression(self):
+        return (self._tOptions["initramfs"]["compression"],
+                self._tOptions["initramfs"]["compression-level"],
+                self._tOptions["initramfs"]["compression-threads"])
+
     def get_system_init(self):
         if self._tOptions["system"]["init"] == "auto-detect":
             if os.path.exists("/sbin/openrc-init"):
@@ -149,12 +187,40 @@ class Config(ConfigBase):
     def get_kernel_extra_init_cmdline(self):
         return self._tOptions["kernel"]["init-cmdline"]
 
+    def get_kernel_incremental_build(self):
+        return self._tOptions["kernel"]["incremental-build"]
+
     def test_version_mask(self, item_fullname, item_verstr):
-        for buf in self._tMaskBufList:
-            m = re.search("^>%s-(.*)$" % (item_fullname), buf, re.M)
-            if m is not None:
-                if Util.compareVerstr(item_verstr, m.group(1)) > 0:
+        ruleList = self._tMaskRuleDict.get(item_fullname)
+        if ruleList is None:
+            return True
+
+        itemKey = Util.verstrToKey(item_verstr)
+        for op, verstr, key in ruleList:
+            if op == "":
+                return False
+            elif op == ">":
+                if itemKey > key:
+                    return False
+            elif op == ">=":
+                if itemKey >= key:
+                    return False
+            elif op == "<":
+                if itemKey < key:
                     return False
+            elif op == "<=":
+                if itemKey <= key:
+                    return False
+            elif op == "=":
+                if itemKey == key:
+                    return False
+            elif op == "=*":
+                # "5.1*" matches "5.1", "5.1.2" and "5.1-rc3", but not "5.10"
+                if item_verstr.startswith(verstr):
+                    if len(item_verstr) == len(verstr) or not verstr[-1].isdigit() or not item_verstr[len(verstr)].isdigit():
+                        return False
+            else:
+                assert False
         return True
 
     def check_against_repositories(self, repositories, autofix, error_callback):
@@ -244,6 +310,55 @@ class Config(ConfigBase):
                     self._tOptions["bootloader"]["wait-time"] = v
                 if cfg.has_option("kernel", "init-cmdline"):
                     self._tOptions["kernel"]["init-cmdline"] = cfg.get("kernel", "init-cmdline")
+                if cfg.has_option("kernel", "incremental-build"):
+                    v = cfg.get("kernel", "incremental-build")
+                    if v == "true":
+                        self._tOptions["kernel"]["incremental-build"] = True
+                    elif v == "false":
+                        self._tOptions["kernel"]["incremental-build"] = False
+                    else:
+                        raise ConfigError("invalid value of bbki option kernel/incremental-build")
+                if cfg.has_option("distfiles", "ro-dirs"):
+                    v = cfg.get("distfiles", "ro-dirs").split()
+                    if not all([os.path.isabs(x) for x in v]):
+                        raise ConfigError("invalid value of bbki option distfiles/ro-dirs")
+                    self._tOptions["distfiles"]["ro-dirs"] = v
+                if cfg.has_option("build", "compiler-cache"):
+                    v = cfg.get("build", "compiler-cache")
+                    if v == "none":
+                        v = None
+                    elif v not in CompilerCache.get_compiler_cache_names():
+                        raise ConfigError("invalid value of bbki option build/compiler-cache")
+                    self._tOptions["build"]["compiler-cache"] = v
+                if cfg.has_option("srctree", "cache-size"):
+                    m = re.fullmatch(r'([0-9]+)([KMGT]?)', cfg.get("srctree", "cache-size"))
+                    if m is None:
+                        raise ConfigError("invalid value of bbki option srctree/cache-size")
+                    self._tOptions["srctree"]["cache-size"] = int(m.group(1)) * {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}[m.group(2)]
+                if cfg.has_option("initramfs", "compression"):
+                    v = cfg.get("initramfs", "compression")
+                    if v != "auto" and v not in InitramfsCompressor.get_compressor_names():
+                        raise ConfigError("invalid value of bbki option initramfs/compression")
+                    self._tOptions["initramfs"]["compression"] = v
+                if cfg.has_option("initramfs", "compression-level"):
+                    v = cfg.get("initramfs", "compression-level")
+                    if v == "default":
+                        v = None
+                    else:
+                        try:
+                            v = int(v)
+                        except ValueError:
+                            raise ConfigError("invalid value of bbki option initramfs/compression-level")
+                    self._tOptions["initramfs"]["compression-level"] = v
+                if cfg.has_option("initramfs", "compression-threads"):
+                    v = cfg.get("initramfs", "compression-threads")
+                    try:
+                        v = int(v)
+                    except ValueError:
+                        raise ConfigError("invalid value of bbki option initramfs/compression-threads")
+                    if v < 0:
+                        raise ConfigError("invalid value of bbki option initramfs/compression-threads")
+                    self._tOptions["initramfs"]["compression-threads"] = v
                 if cfg.has_option("system", "init"):
                     v = cfg.get("system", "init")
                     if v != "auto-detect" and v not in [SystemInit.TYPE_SYSVINIT, SystemInit.TYPE_OPENRC, SystemInit.TYPE_SYSTEMD] and not v.startswith("/"):
@@ -264,6 +379,21 @@ class Config(ConfigBase):
             },
             "kernel": {
                 "init-cmdline": "",
+                "incremental-build": False,         # keep kernel build directory (KBUILD_OUTPUT) across installations
+            },
+            "distfiles": {
+                "ro-dirs": [],                      # read-only distfile directories, eg. shared by NFS, searched before cache_distfiles_dir
+            },
+            "build": {
+                "compiler-cache": None,             # "ccache" or "sccache", None means no compiler cache
+            },
+            "srctree": {
+                "cache-size": 8 * 1024 ** 3,        # in bytes, can be specified with suffix K, M, G or T, 0 means no caching
+            },
+            "initramfs": {
+                "compression": "auto",
+                "compression-level": None,          # None means default level of the compressor
+                "compression-threads": 0,           # 0 means all the CPUs
             },
             "system": {
                 "init": "auto-detect",
@@ -273,16 +403,44 @@ class Config(ConfigBase):
         __myParse(self._profileOptionsFile)      # step1: use /etc/bbki/profile/bbki.*
         __myParse(self._cfgOptionsFile)          # step2: use /etc/bbki/bbki.*
 
-    def _filltMaskBufList(self):
-        assert self._tMaskBufList is None
+        # compression level range is specific to the compressor, which may be specified in a different file
+        v = self._tOptions["initramfs"]["compression-level"]
+        if v is not None:
+            minLevel, maxLevel = InitramfsCompressor.get_level_range(self._tOptions["initramfs"]["compression"])
+            if not (minLevel <= v <= maxLevel):
+                raise ConfigError("invalid value of bbki option initramfs/compression-level")
+
+    def _filltMaskRuleDict(self):
+        # mask rule format: {
+        #     "linux/vanilla": [(operator, verstr, version-key), ...],
+        # }
+        # line format: "linux/vanilla" (all versions), ">linux/vanilla-5.15.3", ">=", "<", "<=", "=", "=linux/vanilla-5.15*" (wildcard)
+        assert self._tMaskRuleDict is None
 
         def __myParse(path):
             if os.path.exists(path):
-                for fn in os.listdir(path):
-                    with open(os.path.join(path, fn), "r") as f:
-                        self._tMaskBufList.append(f.read())
-
-        self._tMaskBufList = []
+                for fn in sorted(os.listdir(path)):
+                    fullfn = os.path.join(path, fn)
+                    for line in pathlib.Path(fullfn).read_text().split("\n"):
+                        line = line.strip()
+                        if line == "" or line.startswith("#"):
+                            continue
+                        # a line without operator is a whole atom name, which may contain "-<digit>", eg. "linux-addon/wifi-8812au"
+                        # otherwise name is greedy, so the version starts after the last "-<digit>", eg. "=linux-addon/nvidia-470-5.1"
+                        m = re.fullmatch(r'([^\s<>=*]+)', line)
+                        if m is not None:
+                            self._tMaskRuleDict.setdefault(m.group(1), []).append(("", None, None))
+                            continue
+                        m = re.fullmatch(r'(>=|<=|>|<|=)([^\s<>=*]+)-([0-9][^\s*]*)(\*)?', line)
+                        if m is None or (m.group(4) is not None and m.group(1) != "="):
+                            raise ConfigError("invalid mask rule \"%s\" in \"%s\"" % (line, fullfn))
+                        if m.group(4) is not None:
+                            rule = ("=*", m.group(3), None)
+                        else:
+                            rule = (m.group(1), m.group(3), Util.verstrToKey(m.group(3)))
+                        self._tMaskRuleDict.setdefault(m.group(2), []).append(rule)
+
+        self._tMaskRuleDict = dict()
         __myParse(self._profileMaskDir)      # step1: use /etc/bbki/profile/bbki.*
         __myParse(self._cfgMaskDir)          # step2: use /etc/bbki/bbki.*
 
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2005-2014 Fpemud <fpemud@sina.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Feeds the same cpio stream through every initramfs compressor and reports compression time and size.
+# usage: benchmark-initramfs-compressors.py [-l LEVEL] [-t THREADS] [DIRECTORY]
+#        DIRECTORY is archived into the cpio stream, default is /lib/modules/$(uname -r)
+
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import argparse
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "python3"))
+from bbki._cpio import CpioNewcWriter
+from bbki._initramfs_compressor import _compressorList
+
+
+def buildCpio(srcDir, filepath):
+    with open(filepath, "wb") as f:
+        with CpioNewcWriter(f) as writer:
+            for root, dirs, files in os.walk(srcDir):
+                dirs.sort()
+                for fn in sorted(dirs + files):
+                    fullfn = os.path.join(root, fn)
+                    name = os.path.relpath(fullfn, srcDir)
+                    if os.path.islink(fullfn):
+                        writer.add_symlink(name, os.readlink(fullfn))
+                    elif os.path.isdir(fullfn):
+                        writer.add_directory(name)
+                    elif os.path.isfile(fullfn):
+                        writer.add_file(name, fullfn)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-l", "--level", type=int, default=None, help="compression level, default level of each compressor is used if not specified")
+    parser.add_argument("-t", "--threads", type=int, default=0, help="compression threads, 0 means using all the CPUs")
+    parser.add_argument("directory", nargs="?", default=os.path.join("/lib/modules", os.uname().release))
+    args = parser.parse_args()
+
+    tmpDir = tempfile.mkdtemp(prefix="bbki-benchmark-")
+    try:
+        cpioFile = os.path.join(tmpDir, "initramfs.cpio")
+        buildCpio(args.directory, cpioFile)
+        with open(cpioFile, "rb") as f:
+            data = f.read()
+        print("input: %s, %d bytes of cpio stream" % (args.directory, len(data)))
+        print("")
+
+        print("%-8s %8s %12s %8s" % ("name", "time(s)", "size", "ratio"))
+        for klass in _compressorList:
+            if args.level is not None and not (klass.LEVEL_RANGE[0] <= args.level <= klass.LEVEL_RANGE[1]):
+                print("%-8s skipped, level %d is out of range %d..%d" % (klass.NAME, args.level, klass.LEVEL_RANGE[0], klass.LEVEL_RANGE[1]))
+                continue
+            outFile = os.path.join(tmpDir, "initramfs.cpio." + klass.NAME)
+            t = time.monotonic()
+            try:
+                with klass(args.level, args.threads).open(outFile) as f:
+                    f.write(data)
+            except FileNotFoundError as e:
+                # external compressor program is not installed
+                print("%-8s skipped, %s" % (klass.NAME, e))
+                continue
+            t = time.monotonic() - t
+            size = os.path.getsize(outFile)
+            print("%-8s %8.2f %12d %7.1f%%" % (klass.NAME, t, size, size * 100 / len(data)))
+            os.unlink(outFile)
+    finally:
+        shutil.rmtree(tmpDir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2005-2014 Fpemud <fpemud@sina.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Times the kernel module scan (the firmware index refresh) serially (scan_jobs=1) and with the default process pool.
+# A synthetic modules directory is generated, each kernel module is a minimal ELF object file with a .modinfo section.
+# usage: benchmark-kmod-scan.py [-n MODULES] [-s MODULE_SIZE] [-r REPEAT]
+
+
+import os
+import sys
+import time
+import types
+import shutil
+import struct
+import tempfile
+import argparse
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "python3"))
+from bbki._boot_entry import BootEntryWrapper
+
+
+def makeKmodFile(filepath, modinfoList, textSize):
+    # ELF64 little-endian relocatable file with sections: NULL, .text, .modinfo, .shstrtab
+    shstrtab = b"\0.text\0.modinfo\0.shstrtab\0"
+    text = b"\0" * textSize
+    modinfo = b"".join([x.encode("utf-8") + b"\0" for x in modinfoList])
+
+    data = b""
+    sectionList = [(0, 0, 0, b"")]                                                      # (name, type, flags, content)
+    sectionList.append((shstrtab.index(b".text"), 1, 0x6, text))                         # SHT_PROGBITS, SHF_ALLOC|SHF_EXECINSTR
+    sectionList.append((shstrtab.index(b".modinfo"), 1, 0x2, modinfo))                  # SHT_PROGBITS, SHF_ALLOC
+    sectionList.append((shstrtab.index(b".shstrtab"), 3, 0, shstrtab))                  # SHT_STRTAB
+
+    offsetList = []
+    for name, shType, flags, content in sectionList:
+        offsetList.append(64 + len(data) if content != b"" else 0)
+        data += content
+    shoff = 64 + len(data)
+
+    with open(filepath, "wb") as f:
+        f.write(struct.pack("<16sHHIQQQIHHHHHH", b"\x7fELF\x02\x01\x01" + b"\0" * 9, 1, 62, 1, 0, 0, shoff, 0, 64, 0, 0, 64, len(sectionList), len(sectionList) - 1))
+        f.write(data)
+        for (name, shType, flags, content), offset in zip(sectionList, offsetList):
+            f.write(struct.pack("<IIQQQQIIQQ", name, shType, flags, 0, offset, len(content), 0, 0, 1, 0))
+
+
+def makeModulesDir(modulesDir, moduleCount, moduleSize):
+    for i in range(0, moduleCount):
+        dirpath = os.path.join(modulesDir, "kernel", "drivers", "dir%03d" % (i // 100))
+        os.makedirs(dirpath, exist_ok=True)
+        modinfoList = [
+            "license=GPL",
+            "description=synthetic kernel module %d" % (i),
+            "alias=synthetic:%d" % (i),
+            "depends=",
+            "name=mod%05d" % (i),
+        ]
+        if i % 5 == 0:
+            modinfoList.append("firmware=synthetic/fw%05d.bin" % (i))
+        makeKmodFile(os.path.join(dirpath, "mod%05d.ko" % (i)), modinfoList, moduleSize)
+
+
+def runScan(bootEntry, scanJobs, repeat):
+    # returns the best time of several runs, firmware index is removed before each run so that all the kernel modules are scanned
+    obj = BootEntryWrapper(bootEntry, scan_jobs=scanJobs)
+    best = None
+    result = None
+    for i in range(0, repeat):
+        if os.path.exists(obj._fwIndexFile):
+            os.unlink(obj._fwIndexFile)
+        t = time.monotonic()
+        result = obj._refreshFirmwareIndex(bIgnoreError=False)
+        t = time.monotonic() - t
+        best = t if best is None else min(best, t)
+    return (best, result)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--modules", type=int, default=5000, help="number of kernel modules to generate")
+    parser.add_argument("-s", "--module-size", type=int, default=16 * 1024, help="size of the .text section of each kernel module")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="number of runs, the best time is reported")
+    args = parser.parse_args()
+
+    tmpDir = tempfile.mkdtemp(prefix="bbki-benchmark-")
+    try:
+        modulesDir = os.path.join(tmpDir, "lib", "modules", "0.0.0-synthetic")
+        makeModulesDir(modulesDir, args.modules, args.module_size)
+
+        # BootEntryWrapper only needs the kernel modules directory from the boot entry
+        fsLayout = types.SimpleNamespace(get_kernel_modules_dir=lambda verstr: modulesDir)
+        bootEntry = types.SimpleNamespace(_bbki=types.SimpleNamespace(_fsLayout=fsLayout), verstr="0.0.0-synthetic")
+
+        print("%d kernel modules, %d CPUs" % (args.modules, os.cpu_count()))
+        serialTime, serialResult = runScan(bootEntry, 1, args.repeat)
+        print("scan_jobs=1:       %.3fs" % (serialTime))
+        parallelTime, parallelResult = runScan(bootEntry, None, args.repeat)
+        print("scan_jobs=default: %.3fs (%.2fx)" % (parallelTime, serialTime / parallelTime))
+        if serialResult != parallelResult:
+            print("error: results are different")
+            sys.exit(1)
+    finally:
+        shutil.rmtree(tmpDir)
+
+
+if __name__ == "__main__":
+    main()
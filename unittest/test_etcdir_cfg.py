@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2005-2014 Fpemud <fpemud@sina.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+from bbki.etcdir_cfg import Config
+
+
+class TestMaskRule(unittest.TestCase):
+
+    def setUp(self):
+        self.cfgDir = tempfile.mkdtemp()
+        with open(os.path.join(self.cfgDir, "bbki.kernel"), "w") as f:
+            f.write("linux/vanilla\n")
+        os.mkdir(os.path.join(self.cfgDir, "bbki.mask"))
+
+    def tearDown(self):
+        shutil.rmtree(self.cfgDir)
+
+    def _loadConfig(self, buf):
+        with open(os.path.join(self.cfgDir, "bbki.mask", "test"), "w") as f:
+            f.write(buf)
+        return Config(self.cfgDir)
+
+    def test_name_with_digit(self):
+        # a line without operator is a whole atom name, "-8812au" is not a version
+        cfg = self._loadConfig("linux-addon/wifi-8812au\n")
+        self.assertFalse(cfg.test_version_mask("linux-addon/wifi-8812au", "1.0"))
+        self.assertTrue(cfg.test_version_mask("linux-addon/wifi", "8812au"))
+
+    def test_versioned_name_with_digit(self):
+        # version starts after the last "-<digit>"
+        cfg = self._loadConfig("=linux-addon/nvidia-470-5.1\n")
+        self.assertFalse(cfg.test_version_mask("linux-addon/nvidia-470", "5.1"))
+        self.assertTrue(cfg.test_version_mask("linux-addon/nvidia-470", "5.2"))
+        self.assertTrue(cfg.test_version_mask("linux-addon/nvidia", "470-5.1"))
+
+    def test_versioned(self):
+        cfg = self._loadConfig(">=linux/vanilla-6.1-r2\n=linux/vanilla-5.15*\n")
+        self.assertFalse(cfg.test_version_mask("linux/vanilla", "6.1-r2"))
+        self.assertTrue(cfg.test_version_mask("linux/vanilla", "6.1-r1"))
+        self.assertFalse(cfg.test_version_mask("linux/vanilla", "5.15.3"))
+        self.assertTrue(cfg.test_version_mask("linux/vanilla", "5.14"))
+
+
+if __name__ == "__main__":
+    unittest.main()
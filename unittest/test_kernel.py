@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2005-2014 Fpemud <fpemud@sina.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import time
+import threading
+import unittest
+from bbki._kernel import KernelInstaller
+from bbki._kernel import _splitMakeOpts
+
+
+class FakeAtom:
+
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeExecutor:
+
+    """Records the calls of kernel_addon_build and kernel_addon_install"""
+
+    def __init__(self, log, barrier=None, depend=None):
+        self._log = log
+        self._barrier = barrier
+        self._depend = depend
+
+    def has_variable(self, var_name):
+        return var_name == "ADDON_DEPEND" and self._depend is not None
+
+    def get_variable(self, var_name):
+        return self._depend
+
+    def exec_kernel_addon_build(self, kernel_atom, boot_entry, makeopts=None):
+        self._log.append(("build", self, makeopts))
+        if self._barrier is not None:
+            # raises threading.BrokenBarrierError if the other addons are not built at the same time
+            self._barrier.wait(timeout=10)
+
+    def exec_kernel_addon_install(self, kernel_atom, boot_entry, makeopts=None):
+        self._log.append(("install-begin", self, makeopts))
+        time.sleep(0.1)                 # give the other addons a chance to run into the installation
+        self._log.append(("install-end", self, makeopts))
+
+
+class TestInstallAddons(unittest.TestCase):
+
+    def _newInstaller(self, makeOpts, executorDict):
+        obj = KernelInstaller.__new__(KernelInstaller)
+        obj._kernelAtom = FakeAtom("vanilla")
+        obj._targetBootEntry = None
+        obj._makeOpts = makeOpts
+        obj._addonAtomList = list(executorDict)
+        obj._executorDict = dict(executorDict)
+        return obj
+
+    def test_split_makeopts(self):
+        self.assertEqual(_splitMakeOpts("-j8 -l8", 2), (2, "-j4 -l8"))
+        self.assertEqual(_splitMakeOpts("--jobs=8", 3), (3, "--jobs=2"))
+        self.assertEqual(_splitMakeOpts("-j2", 4), (2, "-j1"))
+        self.assertEqual(_splitMakeOpts("", 4), (1, ""))
+        self.assertEqual(_splitMakeOpts("-j8", 0), (0, "-j8"))
+
+    def test_concurrent_build(self):
+        log = []
+        barrier = threading.Barrier(2)
+        a, b = FakeAtom("a"), FakeAtom("b")
+        executorDict = {a: FakeExecutor(log, barrier), b: FakeExecutor(log, barrier)}
+        self._newInstaller("-j8 -l8", executorDict)._installAddons()
+
+        # builds get the divided job count, installations get the full one and never overlap
+        buildList = [x for x in log if x[0] == "build"]
+        self.assertEqual(len(buildList), 2)
+        for action, executor, makeopts in buildList:
+            self.assertEqual(makeopts, _splitMakeOpts("-j8 -l8", 2)[1])
+        installList = [x for x in log if x[0].startswith("install-")]
+        self.assertEqual([x[0] for x in installList], ["install-begin", "install-end"] * 2)
+        for action, executor, makeopts in installList:
+            self.assertEqual(makeopts, "-j8 -l8")
+
+    def test_depend(self):
+        log = []
+        a, b = FakeAtom("a"), FakeAtom("b")
+        executorDict = {b: FakeExecutor(log, depend="a"), a: FakeExecutor(log)}
+        self._newInstaller("-j8", executorDict)._installAddons()
+
+        # b is built only after a is installed
+        self.assertEqual([(x[0], x[1]) for x in log], [
+            ("build", executorDict[a]),
+            ("install-begin", executorDict[a]),
+            ("install-end", executorDict[a]),
+            ("build", executorDict[b]),
+            ("install-begin", executorDict[b]),
+            ("install-end", executorDict[b]),
+        ])
+
+
+if __name__ == "__main__":
+    unittest.main()